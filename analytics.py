@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Индексированное хранилище истории взаимодействий (SQLite) для аналитики.
+
+CSV-журнал logs/telegram_bot_logs.csv только дописывается и не индексируется,
+поэтому любой агрегирующий вопрос требует чтения всего файла. Здесь каждая
+запись журнала дублируется в SQLite с индексами по chat_id, datetime и
+message_type; существующий CSV импортируется один раз.
+
+Использование из командной строки:
+    python analytics.py summary --days 7
+    python analytics.py chats --days 7 --limit 20
+    python analytics.py types --days 30
+    python analytics.py import logs/telegram_bot_logs.csv
+"""
+
+import argparse
+import csv
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timedelta
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS interactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id INTEGER NOT NULL,
+    datetime TEXT NOT NULL,
+    message_type TEXT NOT NULL,
+    message_len INTEGER NOT NULL,
+    response_len INTEGER NOT NULL,
+    message TEXT,
+    ai_response TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_interactions_chat_datetime ON interactions (chat_id, datetime);
+CREATE INDEX IF NOT EXISTS idx_interactions_datetime ON interactions (datetime);
+CREATE INDEX IF NOT EXISTS idx_interactions_type_datetime ON interactions (message_type, datetime);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class AnalyticsStore:
+    """
+    Args:
+        db_path (str): Путь к файлу SQLite.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _row(chat_id, current_time, message, message_type, ai_response):
+        message = message or ''
+        ai_response = ai_response or ''
+        return (int(chat_id), current_time, message_type or '', len(message), len(ai_response), message, ai_response)
+
+    def record(self, chat_id, current_time, message, message_type, ai_response):
+        """Добавляет одно взаимодействие (вызывается при каждой записи в CSV-журнал)."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO interactions (chat_id, datetime, message_type, message_len, response_len, message, ai_response) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._row(chat_id, current_time, message, message_type, ai_response),
+            )
+
+    def import_csv(self, csv_path, once=True):
+        """
+        Импортирует существующий CSV-журнал.
+
+        При once=True импорт выполняется только один раз для базы (отметка
+        хранится в таблице meta), что безопасно и при одновременном запуске
+        нескольких процессов.
+
+        Returns:
+            int: Количество импортированных записей.
+        """
+        if not os.path.exists(csv_path):
+            return 0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if once and self._conn.execute("SELECT 1 FROM meta WHERE key = 'csv_imported'").fetchone():
+                    self._conn.execute("COMMIT")
+                    return 0
+                rows = []
+                with open(csv_path, newline='', encoding='utf-8') as file:
+                    for row in csv.DictReader(file):
+                        try:
+                            rows.append(self._row(row['chat_id'], row['datetime'], row.get('message'),
+                                                  row.get('message_type'), row.get('ai_response')))
+                        except (KeyError, ValueError, TypeError):
+                            continue
+                self._conn.executemany(
+                    "INSERT INTO interactions (chat_id, datetime, message_type, message_len, response_len, message, ai_response) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('csv_imported', ?)",
+                    (datetime.now().strftime(DATETIME_FORMAT),),
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logging.info(f"Импортировано {len(rows)} записей из {csv_path} в {self.db_path}")
+        return len(rows)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def totals(self, since):
+        """Общее число сообщений, чатов и средние длины начиная с since."""
+        return self._query(
+            "SELECT COUNT(*), COUNT(DISTINCT chat_id), AVG(message_len), AVG(response_len) "
+            "FROM interactions WHERE datetime >= ?",
+            (since,),
+        )[0]
+
+    def messages_per_chat(self, since, limit=10):
+        return self._query(
+            "SELECT chat_id, COUNT(*) AS cnt, MAX(datetime) FROM interactions WHERE datetime >= ? "
+            "GROUP BY chat_id ORDER BY cnt DESC LIMIT ?",
+            (since, limit),
+        )
+
+    def by_message_type(self, since):
+        return self._query(
+            "SELECT message_type, COUNT(*) AS cnt, AVG(message_len), AVG(response_len) FROM interactions "
+            "WHERE datetime >= ? GROUP BY message_type ORDER BY cnt DESC",
+            (since,),
+        )
+
+    def per_day(self, since):
+        return self._query(
+            "SELECT substr(datetime, 1, 10) AS day, COUNT(*) FROM interactions WHERE datetime >= ? "
+            "GROUP BY day ORDER BY day",
+            (since,),
+        )
+
+
+def since_days(days):
+    return (datetime.now() - timedelta(days=days)).strftime(DATETIME_FORMAT)
+
+
+def format_stats(store, days=7, limit=5):
+    """Текстовый отчет для команды /stats и командной строки."""
+    since = since_days(days)
+    count, chats, avg_message, avg_response = store.totals(since)
+    lines = [
+        f"📊 Статистика за {days} дн.",
+        f"Сообщений: {count}, чатов: {chats}",
+        f"Средняя длина запроса: {round(avg_message or 0)} симв., ответа: {round(avg_response or 0)} симв.",
+        "",
+        "По типам сообщений:",
+    ]
+    for message_type, cnt, avg_msg, avg_resp in store.by_message_type(since):
+        lines.append(f"- {message_type}: {cnt} (запрос ~{round(avg_msg or 0)}, ответ ~{round(avg_resp or 0)} симв.)")
+    lines += ["", f"Самые активные чаты (топ-{limit}):"]
+    for chat_id, cnt, last in store.messages_per_chat(since, limit):
+        lines.append(f"- {chat_id}: {cnt} (последнее {last})")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Аналитика по истории взаимодействий бота")
+    parser.add_argument('--db', default=os.path.join(os.getenv('BOT_LOGS_DIR', 'logs'), 'analytics.sqlite3'),
+                        help="Файл базы аналитики")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    summary = subparsers.add_parser('summary', help="Сводный отчет")
+    summary.add_argument('--days', type=int, default=7)
+
+    chats = subparsers.add_parser('chats', help="Сообщения по чатам")
+    chats.add_argument('--days', type=int, default=7)
+    chats.add_argument('--limit', type=int, default=20)
+
+    types = subparsers.add_parser('types', help="Статистика по типам сообщений")
+    types.add_argument('--days', type=int, default=7)
+
+    daily = subparsers.add_parser('daily', help="Сообщения по дням")
+    daily.add_argument('--days', type=int, default=30)
+
+    importer = subparsers.add_parser('import', help="Импорт CSV-журнала")
+    importer.add_argument('csv_path', nargs='?', default=os.path.join(os.getenv('BOT_LOGS_DIR', 'logs'), 'telegram_bot_logs.csv'))
+    importer.add_argument('--force', action='store_true', help="Импортировать повторно, даже если импорт уже был")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command != 'import' and not os.path.exists(args.db):
+        print(f"База {args.db} не найдена. Выполните: python analytics.py import")
+        sys.exit(1)
+    store = AnalyticsStore(args.db)
+
+    if args.command == 'import':
+        print(f"Импортировано записей: {store.import_csv(args.csv_path, once=not args.force)}")
+    elif args.command == 'summary':
+        print(format_stats(store, args.days))
+    elif args.command == 'chats':
+        for chat_id, cnt, last in store.messages_per_chat(since_days(args.days), args.limit):
+            print(f"{chat_id}\t{cnt}\t{last}")
+    elif args.command == 'types':
+        for message_type, cnt, avg_msg, avg_resp in store.by_message_type(since_days(args.days)):
+            print(f"{message_type}\t{cnt}\t{round(avg_msg or 0)}\t{round(avg_resp or 0)}")
+    elif args.command == 'daily':
+        for day, cnt in store.per_day(since_days(args.days)):
+            print(f"{day}\t{cnt}")
+
+
+if __name__ == '__main__':
+    main()
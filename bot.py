@@ -1,11 +1,15 @@
 # Стандартные библиотеки Python
 import csv
+import hashlib
 import http.client
 import io
 import logging
 import os
 import re
 import sys
+import threading
+import time
+from collections import deque
 from datetime import datetime
 from urllib.parse import urlparse
 
@@ -28,6 +32,17 @@ except ImportError as e:
     print("💡 Установите зависимости: pip install -r requirements.txt")
     sys.exit(1)
 
+# Модули проекта (импортируются после проверки зависимостей: downloads использует requests)
+from analytics import AnalyticsStore, format_stats
+from cache import SQLiteCache
+from dedup import open_update_index
+from downloads import DownloadManager
+from job_queue import QUEUED_UPDATE_KEYS, open_job_queue, raw_update
+from load_shedding import DEFER, FAST_MODELS, NO_HEAVY_MEDIA, LoadShedder
+from message_store import MessageStore
+from model_router import ModelRouter, truncated
+from tracing import Tracer
+
 # Загружаем переменные окружения из файла config.env
 load_dotenv('config.env')
 
@@ -40,7 +55,166 @@ if not API_TOKEN:
     logging.critical("Необходимо установить переменную окружения TELEGRAM_BOT_TOKEN в файле config.env!")
     exit(1)
 
-bot = telebot.TeleBot(API_TOKEN)
+# Путь к файлу логов (локальная папка, можно переопределить через BOT_LOGS_DIR)
+logs_dir = os.getenv('BOT_LOGS_DIR', 'logs')
+if not os.path.exists(logs_dir):
+    os.makedirs(logs_dir)
+file_path = os.path.join(logs_dir, 'telegram_bot_logs.csv')
+
+# Индекс обработанных апдейтов (защита от повторной доставки)
+update_index = open_update_index(logs_dir)
+
+# Трассировка апдейтов: спаны в JSONL с ротацией и выборочное профилирование медленных апдейтов.
+# Рабочие процессы супервизора пишут каждый в свой файл: ротация RotatingFileHandler
+# переименовывает файл и небезопасна, если в него пишут несколько процессов
+worker_slot = os.getenv('BOT_WORKER_SLOT')
+tracer = Tracer(
+    os.path.join(logs_dir, f'traces.{worker_slot}.jsonl' if worker_slot else 'traces.jsonl')
+    if os.getenv('TRACING_ENABLED', '1') == '1' else '',
+    profile_percent=float(os.getenv('TRACE_PROFILE_PERCENT', 0)),
+    profile_dir=os.path.join(logs_dir, 'profiles'),
+)
+
+# Управление нагрузкой: по глубине очереди и задержке выбирается уровень деградации
+load_shedder = LoadShedder(
+    depth_thresholds=[int(x) for x in os.getenv('LOAD_QUEUE_THRESHOLDS', '4,8,16,32').split(',')],
+    latency_target=float(os.getenv('LOAD_LATENCY_TARGET_SECONDS', 30)),
+    recovery_seconds=float(os.getenv('LOAD_RECOVERY_SECONDS', 30)),
+)
+
+# Надежная очередь апдейтов: апдейт сохраняется до подтверждения Telegram,
+# завершенные этапы обработки — как контрольные точки для продолжения после перезапуска
+jobs = open_job_queue(logs_dir)
+
+# Апдейты, отложенные при перегрузке, и поток, который возвращает их в обработку
+deferred_updates = deque()
+deferred_lock = threading.Lock()
+deferred_thread = None
+
+
+def update_message(update):
+    """Возвращает сообщение из апдейта (новое, отредактированное или пост канала)."""
+    for attr in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = getattr(update, attr, None)
+        if message is not None:
+            return message
+    return None
+
+
+class AssistantBot(telebot.TeleBot):
+    """
+    TeleBot, который отбрасывает повторно доставленные апдейты до запуска
+    обработчиков, сохраняет новые апдейты в надежную очередь и откладывает
+    их при перегрузке.
+    """
+
+    def process_new_updates(self, updates):
+        fresh_updates = []
+        for update in updates:
+            if update_index.check_and_mark(update):
+                fresh_updates.append(update)
+            else:
+                # Повторный апдейт тоже подтверждаем, иначе Telegram будет присылать его снова
+                self.last_update_id = max(self.last_update_id, update.update_id)
+                logging.info(f"Пропускаем повторный апдейт {update.update_id}")
+        self.process_checked_updates(fresh_updates)
+
+    def process_checked_updates(self, fresh_updates):
+        """
+        Обрабатывает апдейты, уже прошедшие проверку на повтор (в многопроцессном
+        режиме ее выполняет супервизор до записи апдейта в очередь).
+        """
+        for update in fresh_updates:
+            # Запись в очередь синхронная: Telegram получит подтверждение
+            # только следующим getUpdates, когда апдейт уже на диске
+            if self.persist_update(raw_update(update)):
+                self._attach_job(update)
+        if fresh_updates and load_shedder.level() >= DEFER:
+            # Отложенные апдейты уже в очереди — подтверждаем их Telegram сразу
+            self.last_update_id = max(self.last_update_id, max(u.update_id for u in fresh_updates))
+            self.defer_updates(fresh_updates)
+            return
+        super().process_new_updates(fresh_updates)
+
+    def persist_update(self, raw):
+        """
+        Сохраняет сырой апдейт в надежную очередь, если для его типа есть
+        обработчики (иначе апдейт не дойдет до обработчика и не завершится).
+        """
+        handlers = {
+            'message': self.message_handlers,
+            'edited_message': self.edited_message_handlers,
+            'channel_post': self.channel_post_handlers,
+            'edited_channel_post': self.edited_channel_post_handlers,
+        }
+        for kind in QUEUED_UPDATE_KEYS:
+            if kind in raw:
+                if handlers[kind]:
+                    jobs.enqueue(raw)
+                    return True
+                return False
+        return False
+
+    def _attach_job(self, update):
+        message = update_message(update)
+        if message is not None:
+            message.job_id = update.update_id
+
+    def resume_updates(self, updates):
+        """Возвращает в обработку апдейты из очереди, минуя проверку повторов и откладывание."""
+        for update in updates:
+            update_index.check_and_mark(update)
+            self._attach_job(update)
+        if updates:
+            logging.info(f"Продолжаем обработку апдейтов после перезапуска: {len(updates)}")
+            super().process_new_updates(updates)
+
+    def resume_jobs(self):
+        """Продолжает незавершенные апдейты, сохраненные до перезапуска."""
+        self.resume_updates([telebot.types.Update.de_json(raw) for raw in jobs.take_resumable()])
+
+    def _exec_task(self, task, *args, **kwargs):
+        # Завершенная задача удаляет апдейт из очереди, упавшая — оставляет для повтора
+        job_id = getattr(args[0], 'job_id', None) if args else None
+        if job_id is not None:
+            task = jobs.track(task, job_id)
+        # Каждая задача обработчика учитывается в очереди и замерах задержки
+        super()._exec_task(load_shedder.track(task), *args, **kwargs)
+
+    def defer_updates(self, updates):
+        global deferred_thread
+        for update in updates:
+            deferred_updates.append(update)
+            jobs.set_status(update.update_id, 'deferred')
+            message = update_message(update)
+            if message is not None:
+                try:
+                    self.send_message(message.chat.id, "⏳ Сейчас большая нагрузка, обработаю сообщение чуть позже.",
+                                      reply_to_message_id=message.message_id)
+                except Exception as e:
+                    logging.warning(f"Не удалось отправить уведомление об отложенной обработке: {e}")
+        logging.warning(f"Отложено апдейтов: {len(updates)} (всего в ожидании {len(deferred_updates)})")
+        with deferred_lock:
+            if deferred_thread is None:
+                deferred_thread = threading.Thread(target=self._resume_deferred, name='DeferredUpdates', daemon=True)
+                deferred_thread.start()
+
+    def _resume_deferred(self, batch_size=5, interval=5):
+        """Возвращает отложенные апдейты в обработку, когда нагрузка спадает."""
+        while True:
+            time.sleep(interval)
+            if not deferred_updates or load_shedder.level() >= FAST_MODELS:
+                continue
+            batch = []
+            while deferred_updates and len(batch) < batch_size:
+                batch.append(deferred_updates.popleft())
+            logging.info(f"Возвращаем в обработку отложенные апдейты: {len(batch)}")
+            for update in batch:
+                jobs.set_status(update.update_id, 'pending')
+            super().process_new_updates(batch)
+
+
+bot = AssistantBot(API_TOKEN)
 
 # Получение API-ключа OpenAI
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
@@ -69,15 +243,130 @@ if GEMINI_API_KEY:
         logging.warning(f"Не удалось инициализировать Gemini клиент: {e}")
         gemini_client = None
 
-# Путь к файлу логов (локальная папка)
-logs_dir = 'logs'
-if not os.path.exists(logs_dir):
-    os.makedirs(logs_dir)
-file_path = os.path.join(logs_dir, 'telegram_bot_logs.csv')
+# Маршрутизатор моделей: выбор модели и max_tokens под размер и тип запроса
+model_router = ModelRouter(
+    os.path.join(logs_dir, 'model_routing.csv'),
+    latency_budgets={task: float(seconds) for task, seconds in
+                     (item.split('=') for item in os.getenv('MODEL_LATENCY_BUDGETS', '').replace(' ', '').split(',') if item)},
+    max_cost=float(os.getenv('MODEL_MAX_COST_USD', 0)),
+    timeout=float(os.getenv('MODEL_TIMEOUT_SECONDS', 120)),
+    tracer=tracer,
+    load_level=load_shedder.level,
+)
+
+# Общий менеджер загрузки файлов из Telegram
+downloads = DownloadManager(
+    bot, API_TOKEN,
+    max_concurrent=int(os.getenv('DOWNLOAD_CONCURRENCY', 4)),
+    spool_threshold=int(os.getenv('DOWNLOAD_SPOOL_MB', 5)) * 1024 * 1024,
+    tracer=tracer,
+)
+
+# Индексированная копия журнала взаимодействий для аналитики и команды /stats
+analytics = AnalyticsStore(os.path.join(logs_dir, 'analytics.sqlite3'))
+
+# ID пользователей, которым доступна команда /stats (через запятую)
+ADMIN_USER_IDS = {int(x) for x in os.getenv('ADMIN_USER_IDS', '').replace(' ', '').split(',') if x}
 
 # Словарь для хранения истории разговора
 conversation_history = {}
 
+# Кеш ответов для одинакового контента, присланного в разные чаты.
+# Используется, только если история чата пустая или слишком короткая,
+# чтобы повлиять на ответ. Хранится в SQLite, поэтому общий для рабочих
+# процессов супервизора (чаты распределены между процессами).
+response_cache = SQLiteCache(
+    os.path.join(logs_dir, 'response_cache.sqlite3'),
+    maxsize=int(os.getenv('RESPONSE_CACHE_SIZE', 512)),
+    ttl=int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', 6 * 60 * 60)),
+)
+RESPONSE_CACHE_MAX_HISTORY = int(os.getenv('RESPONSE_CACHE_MAX_HISTORY', 2))
+
+# Обработанные сообщения и результаты извлечения (текст ссылок, анализ медиа)
+# для дешевой обработки правок: при правке переиспользуются неизменившиеся части
+message_store = MessageStore(
+    os.path.join(logs_dir, 'messages.sqlite3'),
+    ttl=int(os.getenv('MESSAGE_STORE_TTL_DAYS', 7)) * 24 * 60 * 60,
+)
+# Сколько секунд переиспользовать извлеченный текст страницы по тому же URL
+URL_CACHE_TTL_SECONDS = int(os.getenv('URL_CACHE_TTL_SECONDS', 6 * 60 * 60))
+
+# Типы апдейтов, которые получает бот (включая посты из каналов и правки);
+# все они сохраняются в надежную очередь
+ALLOWED_UPDATES = list(QUEUED_UPDATE_KEYS)
+
+def job_checkpoint(message, stage):
+    """Результат этапа обработки, сохраненный до перезапуска, или None."""
+    job_id = getattr(message, 'job_id', None)
+    return jobs.get_checkpoint(job_id, stage) if job_id is not None else None
+
+def save_job_checkpoint(message, stage, value):
+    job_id = getattr(message, 'job_id', None)
+    if job_id is not None:
+        jobs.save_checkpoint(job_id, stage, value)
+
+def extraction_failed(value):
+    """True, если этап извлечения не дал результата (пусто или текст ошибки)."""
+    return not value or value.startswith(("Ошибка", "Произошла ошибка", "Анализ видео недоступен"))
+
+def checkpointed(message, stage, compute, cache_key=None):
+    """
+    Выполняет этап обработки апдейта или берет его результат из контрольной точки
+    (а при cache_key — из кеша результатов извлечения, общего для всех сообщений).
+    Сохраняются только успешные результаты (непустые и не начинающиеся с «Ошибка»).
+
+    Args:
+        message (telebot.types.Message): Сообщение апдейта.
+        stage (str): Название этапа (например, 'transcript' или 'pdf_text').
+        compute (callable): Функция, возвращающая результат этапа (str).
+        cache_key (str): Ключ в кеше результатов извлечения (см. media_cache_key).
+    """
+    value = job_checkpoint(message, stage)
+    if value is not None:
+        logging.info(f"Этап {stage} восстановлен из контрольной точки")
+        return value
+    if cache_key is not None:
+        value = message_store.get_extraction(cache_key)
+        if value is not None:
+            logging.info(f"Этап {stage} взят из кеша ({cache_key})")
+            return value
+    value = compute()
+    if not extraction_failed(value):
+        save_job_checkpoint(message, stage, value)
+        if cache_key is not None:
+            message_store.save_extraction(cache_key, value)
+    return value
+
+def media_unique_id(message):
+    """file_unique_id медиа в сообщении (одинаков для одного и того же файла) или None."""
+    for attr in ('photo', 'document', 'video', 'voice', 'audio'):
+        media = getattr(message, attr, None)
+        if media:
+            return (media[-1] if isinstance(media, list) else media).file_unique_id
+    return None
+
+def media_cache_key(message, stage):
+    """Ключ кеша результата этапа для медиа сообщения (результат переиспользуется и при другой подписи)."""
+    media_id = media_unique_id(message)
+    return f"{stage}:{media_id}" if media_id else None
+
+def cached_url_text(url):
+    """Текст страницы по URL; недавно извлеченный текст берется из кеша."""
+    cache_key = f"url:{url}"
+    text = message_store.get_extraction(cache_key, max_age=URL_CACHE_TTL_SECONDS)
+    if text is not None:
+        logging.info(f"Текст ссылки взят из кеша: {url}")
+        return text
+    text = extract_text_from_url(url)
+    if not extraction_failed(text):
+        message_store.save_extraction(cache_key, text)
+    return text
+
+def job_files_dir(message):
+    """Папка для сохранения крупных загрузок апдейта (None вне очереди)."""
+    job_id = getattr(message, 'job_id', None)
+    return jobs.files_dir(job_id) if job_id is not None else None
+
 def process_url_in_text(text, bot, chat_id):
     """
     Ищет URL в тексте и, если находит, извлекает текст с веб-страницы.
@@ -88,18 +377,19 @@ def process_url_in_text(text, bot, chat_id):
         chat_id (int): ID чата.
 
     Returns:
-        str: Объединенный текст (исходный текст + текст с веб-страницы) или исходный текст, если URL не найден.
+        tuple: (объединенный текст — исходный текст + текст с веб-страницы, или исходный текст,
+        если URL не найден или текст извлечь не удалось; True, если извлечение не понадобилось или удалось).
     """
     url_match = re.search(r'(http[s]?://[^\s]+)', text)
     if url_match:
         url = url_match.group(0)  # Первая найденная ссылка
         logging.info(f"Извлекаем текст из URL: {url}")
         
-        extracted_text = extract_text_from_url(url)
+        extracted_text = cached_url_text(url)
 
-        if extracted_text and not extracted_text.startswith("Ошибка"):
+        if not extraction_failed(extracted_text):
             logging.info(f"Текст успешно извлечен, длина: {len(extracted_text)} символов")
-            return f"{text}\n\n{extracted_text}"
+            return f"{text}\n\n{extracted_text}", True
         else:
             error_msg = f"Не удалось извлечь текст из ссылки: {extracted_text}"
             logging.warning(error_msg)
@@ -107,11 +397,12 @@ def process_url_in_text(text, bot, chat_id):
                 bot.send_message(chat_id, error_msg)
             except Exception:
                 pass
-            return text
+            return text, False
     else:
-        return text
+        return text, True
 
 # Функция для извлечения текста из URL
+@tracer.traced('extract')
 def extract_text_from_url(url):
     try:
         # Проверяем URL
@@ -170,6 +461,7 @@ def extract_text_from_url(url):
     except Exception as e:
         return f"Произошла ошибка: {e}"
 
+@tracer.traced('extract')
 def extract_video_frames(video_path, max_frames=5):
     """
     Извлекает кадры из видео для анализа
@@ -238,26 +530,36 @@ def analyze_video_with_gemini(video_frames=None, user_message="", video_path=Non
         return "Анализ видео недоступен: Gemini клиент не инициализирован."
 
     try:
-        # Попробуем использовать Gemini 1.5 Pro напрямую
-        logging.info("Пробуем отправить видео в Gemini 1.5 Pro...")
-        if video_path:
-            try:
-                with open(video_path, 'rb') as vf:
-                    response = gemini_client.models.generate_content(
-                        model="gemini-1.5-pro",
-                        contents=[
-                            google_genai.types.Part.from_bytes(
-                                data=vf.read(),
-                                mime_type="video/mp4"
-                            ),
-                            f"Опиши это видео подробно на русском языке. Пользователь написал: {user_message}"
-                        ]
-                    )
+        # Попробуем отправить видео в Gemini напрямую (модель выбирает маршрутизатор).
+        # Под высокой нагрузкой сразу переходим к облегченному гибридному анализу.
+        if video_path and load_shedder.level() >= NO_HEAVY_MEDIA:
+            logging.info("Высокая нагрузка: пропускаем прямой анализ видео в Gemini")
+        elif video_path:
+            with open(video_path, 'rb') as vf:
+                video_bytes = vf.read()
+            for route in model_router.route('video', user_message):
+                logging.info(f"Пробуем отправить видео в {route.model}...")
+                started = time.monotonic()
+                try:
+                    with model_router.span(route):
+                        response = gemini_client.models.generate_content(
+                            model=route.model,
+                            contents=[
+                                google_genai.types.Part.from_bytes(
+                                    data=video_bytes,
+                                    mime_type="video/mp4"
+                                ),
+                                f"Опиши это видео подробно на русском языке. Пользователь написал: {user_message}"
+                            ]
+                        )
+                except Exception as e:
+                    model_router.record(route, time.monotonic() - started, ok=False)
+                    logging.warning(f"Не удалось использовать {route.model} напрямую: {e}")
+                    continue
+                model_router.record(route, time.monotonic() - started, ok=True)
                 if hasattr(response, 'text'):
                     return response.text
                 return str(response)
-            except Exception as e:
-                logging.warning(f"Не удалось использовать Gemini 1.5 Pro напрямую: {e}")
 
         # --- Fallback ---
         logging.info("Используем гибридный анализ (Whisper + сцены).")
@@ -265,7 +567,7 @@ def analyze_video_with_gemini(video_frames=None, user_message="", video_path=Non
         transcript_text = ""
         if video_path:
             try:
-                with open(video_path, 'rb') as audio_file:
+                with open(video_path, 'rb') as audio_file, tracer.span('model_call', model='whisper-1'):
                     transcription = client.audio.transcriptions.create(
                         model="whisper-1",
                         file=(os.path.basename(video_path), audio_file)
@@ -291,10 +593,10 @@ def analyze_video_with_gemini(video_frames=None, user_message="", video_path=Non
 {os.linesep.join(description_parts)}
         Составь связный пересказ видео: сюжет, объекты, действия, выводы. Отвечай на русском языке."""
 
-        chat_completion = client.chat.completions.create(
-            model="gpt-4o-mini",
+        chat_completion = model_router.complete(
+            client, 'video_fallback',
             messages=[{"role": "user", "content": fallback_prompt}],
-            max_tokens=700,
+            input_text=fallback_prompt,
         )
         return chat_completion.choices[0].message.content
 
@@ -304,6 +606,7 @@ def analyze_video_with_gemini(video_frames=None, user_message="", video_path=Non
 
 # Команда /start
 @bot.message_handler(commands=['start'])
+@tracer.traced('handler')
 def send_welcome(message):
     chat_id = message.chat.id
     # Инициализация истории разговора для нового чата
@@ -311,8 +614,25 @@ def send_welcome(message):
         conversation_history[chat_id] = []
     bot.reply_to(message, "Добро пожаловать в канал 'Это не канал'! Как я могу помочь? Бот версии 21_01_2025 г")
 
+# Команда /stats (только для администраторов): /stats [дней]
+@bot.message_handler(commands=['stats'])
+@tracer.traced('handler')
+def send_stats(message):
+    user = getattr(message, 'from_user', None)
+    if user is None or user.id not in ADMIN_USER_IDS:
+        bot.reply_to(message, "Команда доступна только администраторам.")
+        return
+    parts = message.text.split()
+    days = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 7
+    try:
+        bot.reply_to(message, format_stats(analytics, days))
+    except Exception as e:
+        logging.error(f"Ошибка при формировании статистики: {e}")
+        bot.reply_to(message, "Не удалось получить статистику.")
+
 # Обработка текстовых сообщений
 @bot.message_handler(content_types=['text'])
+@tracer.traced('handler')
 def handle_text_message(message):
     chat_id = message.chat.id
     user_message = message.text  # Текст сообщения пользователя
@@ -330,12 +650,14 @@ def handle_text_message(message):
             url = url_match.group(0)  # Первая найденная ссылка
 
             # Пытаемся извлечь текст с веб-страницы
-            extracted_text = extract_text_from_url(url)
+            extracted_text = checkpointed(message, 'url_text', lambda: cached_url_text(url))
 
             if extracted_text:
                 # Объединяем текст сообщения с извлеченным текстом
                 user_message = f"{original_message}\n\n{extracted_text}"
-                process_message(message, user_message, message_type, chat_id)
+                # Ответ по тексту ошибки загрузки страницы не кешируем
+                process_message(message, user_message, message_type, chat_id,
+                                cacheable=not extraction_failed(extracted_text))
             else:
                 bot.reply_to(message, "Не удалось извлечь текст из ссылки.")
         else:
@@ -344,57 +666,67 @@ def handle_text_message(message):
         # Если сообщение не содержит "http", обрабатываем его как обычный текст
         process_message(message, user_message, message_type, chat_id)
 
+def describe_image(image_url):
+    """Запрашивает краткое описание изображения у Vision."""
+    response = model_router.complete(
+        client, 'vision',
+        messages=[
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": "Что на этом изображении? Дай краткое описание на русском языке."},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url,
+                        },
+                    },
+                ],
+            }
+        ],
+    )
+
+    logging.info(f"Ответ от OpenAI Vision API: {response}")  # Логируем полный ответ
+
+    # Извлекаем описание изображения из ответа OpenAI
+    return response.choices[0].message.content
+
 @bot.message_handler(content_types=['photo'])
+@tracer.traced('handler')
 def handle_photo_message(message):
     chat_id = message.chat.id
     user_message = message.caption if message.caption else "Фото без подписи"
     message_type = 'photo'
 
     # Обрабатываем URL в подписи, если он есть
-    user_message += process_url_in_text(user_message, bot, chat_id)
+    user_message, cacheable = process_url_in_text(user_message, bot, chat_id)
+
+    # Под высокой нагрузкой не запрашиваем описание изображения у Vision
+    # (ответ без описания изображения не кешируем)
+    if load_shedder.level() >= NO_HEAVY_MEDIA:
+        logging.info("Высокая нагрузка: пропускаем анализ изображения")
+        process_message(message, user_message, message_type, chat_id, cacheable=False)
+        return
 
     try:
         # Получаем file_id самой большой версии фотографии
         file_id = message.photo[-1].file_id
 
-        # Получаем информацию о файле
-        file_info = bot.get_file(file_id)
-        file_path = file_info.file_path
-        image_url = f'https://api.telegram.org/file/bot{API_TOKEN}/{file_path}'
+        # Получаем URL файла (само изображение скачивает OpenAI)
+        image_url, _ = downloads.file_url(file_id)
 
         logging.info(f"URL изображения: {image_url}")  # Логируем URL
 
     except Exception as e:
         logging.error(f"Ошибка при получении URL изображения из Telegram: {e}")
         user_message += "\nНе удалось получить URL изображения."
-        process_message(message, user_message, message_type, chat_id)
+        process_message(message, user_message, message_type, chat_id, cacheable=False)
         return  # Выходим из функции, чтобы избежать дальнейших ошибок
 
     try:
-        # Запрашиваем описание изображения у OpenAI
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Что на этом изображении? Дай краткое описание на русском языке."},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": image_url,
-                            },
-                        },
-                    ],
-                }
-            ],
-            max_tokens=300,
-        )
-
-        logging.info(f"Ответ от OpenAI Vision API: {response}")  # Логируем полный ответ
-
-        # Извлекаем описание изображения из ответа OpenAI
-        image_description = response.choices[0].message.content
+        # Запрашиваем описание изображения у OpenAI (или берем из контрольной точки)
+        image_description = checkpointed(message, 'image_description', lambda: describe_image(image_url),
+                                         cache_key=media_cache_key(message, 'image_description'))
 
         # Добавляем описание изображения к сообщению пользователя
         user_message += f"\nОписание изображения: {image_description}"
@@ -402,11 +734,13 @@ def handle_photo_message(message):
     except Exception as e:
         logging.error(f"Ошибка при обращении к OpenAI Vision API: {e}")
         user_message += "\nНе удалось получить описание изображения."
+        cacheable = False
 
-    process_message(message, user_message, message_type, chat_id)
+    process_message(message, user_message, message_type, chat_id, cacheable=cacheable)
 
 
 @bot.message_handler(content_types=['document'])
+@tracer.traced('handler')
 def handle_pdf_message(message):
     chat_id = message.chat.id
     user_message = message.caption if message.caption else "Документ"
@@ -425,35 +759,33 @@ def handle_pdf_message(message):
                     "Telegram API не позволяет скачать файлы больше 20 MB. "
                     "Пожалуйста, отправьте укороченную или сжатую версию.")
                 return
-            # Получаем файл
-            file_info = bot.get_file(message.document.file_id)
-            file_path = file_info.file_path
-            video_url = f'https://api.telegram.org/file/bot{API_TOKEN}/{file_path}'
-
-            # Скачиваем во временный файл
-            response = requests.get(video_url, stream=True)
-            response.raise_for_status()
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_file:
-                for chunk in response.iter_content(chunk_size=1024*1024):
-                    if chunk:
-                        temp_file.write(chunk)
-                temp_video_path = temp_file.name
 
-            try:
-                video_frames = extract_video_frames(temp_video_path, max_frames=5)
-                if video_frames:
-                    video_analysis = analyze_video_with_gemini(video_frames, user_message)
-                    first_frame = base64.b64decode(video_frames[0])
-                    bio = io.BytesIO(first_frame); bio.name = 'frame.jpg'
-                    bot.send_photo(chat_id, photo=bio, caption=video_analysis[:1024])
-                    process_message(message, f"{user_message}\n\nАнализ видео (document):\n{video_analysis}", message_type, chat_id)
-                else:
-                    bot.send_message(chat_id, "Не удалось извлечь кадры из видео-документа для анализа.")
-            finally:
-                try:
-                    os.unlink(temp_video_path)
-                except Exception:
-                    pass
+            first_frame = None
+
+            def analyze():
+                nonlocal first_frame
+                # Скачиваем через общий менеджер загрузок (OpenCV нужен путь на диске)
+                with downloads.fetch(message.document.file_id, 'video', file_size, suffix='.mp4',
+                                     checkpoint_dir=job_files_dir(message)) as video_file:
+                    video_frames = extract_video_frames(video_file.as_path('.mp4'), max_frames=5)
+                if not video_frames:
+                    return ''
+                first_frame = base64.b64decode(video_frames[0])
+                return analyze_video_with_gemini(video_frames, user_message)
+
+            # Готовый анализ (из контрольной точки или кеша, в том числе при правке подписи)
+            # не требует повторной загрузки видео и извлечения кадров
+            video_analysis = checkpointed(message, 'video_analysis', analyze,
+                                          cache_key=media_cache_key(message, 'video_analysis'))
+            if not video_analysis:
+                bot.send_message(chat_id, "Не удалось извлечь кадры из видео-документа для анализа.")
+                return
+            # Кадр отправляем только вместе со свежим анализом: при правке подписи он уже отправлен
+            if first_frame is not None and getattr(message, 'edit_date', None) is None:
+                bio = io.BytesIO(first_frame); bio.name = 'frame.jpg'
+                bot.send_photo(chat_id, photo=bio, caption=video_analysis[:1024])
+            process_message(message, f"{user_message}\n\nАнализ видео (document):\n{video_analysis}", message_type, chat_id,
+                            cacheable=not extraction_failed(video_analysis))
         except Exception as e:
             logging.error(f"Ошибка при обработке видео-документа: {e}")
             bot.send_message(chat_id, "Ошибка при обработке видео-документа.")
@@ -465,45 +797,16 @@ def handle_pdf_message(message):
         return
 
     # Обрабатываем URL в подписи, если он есть
-    user_message += process_url_in_text(user_message, bot, chat_id)
-
-    try:
-        # Получаем информацию о файле
-        file_info = bot.get_file(message.document.file_id)
-        file_path = file_info.file_path
-        pdf_url = f'https://api.telegram.org/file/bot{API_TOKEN}/{file_path}'
-
-        logging.info(f"URL PDF документа: {pdf_url}")  # Логируем URL
-
-    except Exception as e:
-        logging.error(f"Ошибка при получении URL PDF документа из Telegram: {e}")
-        user_message += "\nНе удалось получить URL PDF документа."
-        process_message(message, user_message, message_type, chat_id)
-        return
+    user_message, cacheable = process_url_in_text(user_message, bot, chat_id)
 
     try:
-        # Скачиваем PDF файл
-        response = requests.get(pdf_url)
-        response.raise_for_status()
-
-        # Читаем PDF файл
-        pdf_file = io.BytesIO(response.content)
-        pdf_reader = PdfReader(pdf_file)
-
-        # Извлекаем текст из всех страниц
-        pdf_text = ""
-        for page_num, page in enumerate(pdf_reader.pages, 1):
-            try:
-                page_text = page.extract_text()
-                if page_text.strip():  # Проверяем, что страница не пустая
-                    pdf_text += f"\n--- Страница {page_num} ---\n{page_text}"
-            except Exception as e:
-                logging.warning(f"Не удалось извлечь текст со страницы {page_num}: {e}")
-                continue
+        # Скачиваем PDF и извлекаем текст (или берем текст из контрольной точки)
+        pdf_text = checkpointed(message, 'pdf_text', lambda: extract_pdf_text(message),
+                                cache_key=media_cache_key(message, 'pdf_text'))
 
         if not pdf_text.strip():
             user_message += "\nНе удалось извлечь текст из PDF документа."
-            process_message(message, user_message, message_type, chat_id)
+            process_message(message, user_message, message_type, chat_id, cacheable=False)
             return
 
         # Ограничиваем размер текста для API (примерно 4000 токенов)
@@ -515,35 +818,13 @@ def handle_pdf_message(message):
     except Exception as e:
         logging.error(f"Ошибка при обработке PDF файла: {e}")
         user_message += "\nНе удалось обработать PDF файл."
-        process_message(message, user_message, message_type, chat_id)
+        process_message(message, user_message, message_type, chat_id, cacheable=False)
         return
 
     try:
         # Запрашиваем анализ PDF документа у OpenAI
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Проанализируй этот PDF документ и дай краткое описание на русском языке.
-
-                    Включи в описание:
-                    - Тип документа
-                    - Основную тему/содержание
-                    - Ключевые пункты
-                    - Количество страниц (если видно из текста)
-
-                    Текст документа:
-                    {pdf_text}"""
-                }
-            ],
-            max_tokens=500,
-        )
-
-        logging.info(f"Ответ от OpenAI для PDF: {response}")  # Логируем полный ответ
-
-        # Извлекаем анализ PDF из ответа OpenAI
-        pdf_analysis = response.choices[0].message.content
+        pdf_analysis = checkpointed(message, 'pdf_analysis', lambda: analyze_pdf(pdf_text),
+                                    cache_key=media_cache_key(message, 'pdf_analysis'))
 
         # Добавляем анализ PDF к сообщению пользователя
         user_message += f"\n\nАнализ PDF документа:\n{pdf_analysis}"
@@ -551,18 +832,67 @@ def handle_pdf_message(message):
     except Exception as e:
         logging.error(f"Ошибка при обращении к OpenAI для анализа PDF: {e}")
         user_message += "\nНе удалось получить анализ PDF документа."
+        cacheable = False
 
-    process_message(message, user_message, message_type, chat_id)
+    process_message(message, user_message, message_type, chat_id, cacheable=cacheable)
+
+def extract_pdf_text(message):
+    """Скачивает PDF из сообщения и извлекает текст всех страниц."""
+    with downloads.fetch(message.document.file_id, 'document', getattr(message.document, 'file_size', 0),
+                         suffix='.pdf', checkpoint_dir=job_files_dir(message)) as pdf_file:
+        with tracer.span('extract', source='pdf'), pdf_file.open() as stream:
+            # Читаем PDF файл
+            pdf_reader = PdfReader(stream)
+
+            # Извлекаем текст из всех страниц
+            pdf_text = ""
+            for page_num, page in enumerate(pdf_reader.pages, 1):
+                try:
+                    page_text = page.extract_text()
+                    if page_text.strip():  # Проверяем, что страница не пустая
+                        pdf_text += f"\n--- Страница {page_num} ---\n{page_text}"
+                except Exception as e:
+                    logging.warning(f"Не удалось извлечь текст со страницы {page_num}: {e}")
+                    continue
+    return pdf_text
+
+def analyze_pdf(pdf_text):
+    """Запрашивает у модели краткий анализ текста PDF документа."""
+    response = model_router.complete(
+        client, 'pdf',
+        input_text=pdf_text,
+        messages=[
+            {
+                "role": "user",
+                "content": f"""Проанализируй этот PDF документ и дай краткое описание на русском языке.
+
+                Включи в описание:
+                - Тип документа
+                - Основную тему/содержание
+                - Ключевые пункты
+                - Количество страниц (если видно из текста)
+
+                Текст документа:
+                {pdf_text}"""
+            }
+        ],
+    )
+
+    logging.info(f"Ответ от OpenAI для PDF: {response}")  # Логируем полный ответ
+
+    # Извлекаем анализ PDF из ответа OpenAI
+    return response.choices[0].message.content
 
 # Обработка сообщений с видео
 @bot.message_handler(content_types=['video'])
+@tracer.traced('handler')
 def handle_video_message(message):
     chat_id = message.chat.id
     user_message = message.caption if message.caption else "Видео без подписи"
     message_type = 'video'
 
     # Обрабатываем URL в подписи, если он есть
-    user_message = process_url_in_text(user_message, bot, chat_id)
+    user_message, cacheable = process_url_in_text(user_message, bot, chat_id)
 
     try:
         # Быстрая проверка лимита размера: у video обычно есть поле file_size
@@ -574,201 +904,296 @@ def handle_video_message(message):
                 "Пожалуйста, отправьте укороченную или сжатую версию.")
             return
 
-        # Получаем информацию о файле
-        file_id = message.video.file_id
-        file_info = bot.get_file(file_id)
-        file_path = file_info.file_path
-        file_url = f'https://api.telegram.org/file/bot{API_TOKEN}/{file_path}'
-        logging.info(f"URL видео: {file_url}")
-
-        # Скачиваем видео во временный файл
-        response = requests.get(file_url, stream=True)
-        response.raise_for_status()
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as temp_file:
-            for chunk in response.iter_content(chunk_size=1024 * 1024):
-                if chunk:
-                    temp_file.write(chunk)
-            temp_video_path = temp_file.name
+        def analyze():
+            # Скачиваем видео через общий менеджер загрузок
+            with downloads.fetch(message.video.file_id, 'video', video_size, suffix='.mp4',
+                                 checkpoint_dir=job_files_dir(message)) as video_file:
+                # Анализируем через новую функцию (первично Gemini 1.5 Pro, иначе гибрид)
+                return analyze_video_with_gemini(video_frames=None, user_message=user_message,
+                                                 video_path=video_file.as_path('.mp4'))
 
-        try:
-            # Анализируем через новую функцию (первично Gemini 1.5 Pro, иначе гибрид)
-            analysis = analyze_video_with_gemini(video_frames=None, user_message=user_message, video_path=temp_video_path)
-            user_message += f"\n\nАнализ видео:\n{analysis}"
-        finally:
-            try:
-                os.unlink(temp_video_path)
-            except Exception:
-                pass
+        # Готовый анализ из контрольной точки не требует повторной загрузки видео
+        analysis = checkpointed(message, 'video_analysis', analyze,
+                                cache_key=media_cache_key(message, 'video_analysis'))
+        user_message += f"\n\nАнализ видео:\n{analysis}"
+        cacheable = cacheable and not extraction_failed(analysis)
 
     except Exception as e:
         logging.error(f"Ошибка при обработке видео: {e}")
         user_message += f"\nОшибка при обработке видео: {e}"
+        cacheable = False
 
-    process_message(message, user_message, message_type, chat_id)
+    process_message(message, user_message, message_type, chat_id, cacheable=cacheable)
 
 
 # ===== Обработчики постов в канале (channel_post) =====
 # Многие сообщения в каналах приходят как channel_post, поэтому проксируем их в те же обработчики
 
 @bot.channel_post_handler(content_types=['text'])
+@tracer.traced('handler')
 def channel_post_text(message):
     handle_text_message(message)
 
 @bot.channel_post_handler(content_types=['photo'])
+@tracer.traced('handler')
 def channel_post_photo(message):
     handle_photo_message(message)
 
 @bot.channel_post_handler(content_types=['document'])
+@tracer.traced('handler')
 def channel_post_document(message):
     handle_pdf_message(message)
 
 @bot.channel_post_handler(content_types=['video'])
+@tracer.traced('handler')
 def channel_post_video(message):
     handle_video_message(message)
 
+def transcribe_audio(message, media, kind):
+    """Скачивает голосовое или аудио сообщение и возвращает транскрипцию Whisper."""
+    def transcribe():
+        # Скачиваем файл через общий менеджер загрузок
+        with downloads.fetch(media.file_id, kind, getattr(media, 'file_size', 0),
+                             checkpoint_dir=job_files_dir(message)) as audio_file:
+            with tracer.span('model_call', model='whisper-1'), audio_file.open() as stream:
+                transcription = client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(audio_file.name, stream)  # Передаем имя файла и поток с содержимым
+                )
+        return transcription.text
+
+    return checkpointed(message, 'transcript', transcribe, cache_key=media_cache_key(message, 'transcript'))
+
 # Обработка голосовых сообщений
 @bot.message_handler(content_types=['voice'])
+@tracer.traced('handler')
 def handle_voice_message(message):
     chat_id = message.chat.id
     message_type = 'voice'
 
     try:
-        # Получаем информацию о файле
-        file_id = message.voice.file_id
-        file_info = bot.get_file(file_id)
-        file_path = file_info.file_path
-        file_url = f'https://api.telegram.org/file/bot{API_TOKEN}/{file_path}'
-
-        # Скачиваем файл
-        response = requests.get(file_url)
-        response.raise_for_status()  # Проверяем на ошибки
-
-        # Открываем файл как бинарный
-        audio_file = io.BytesIO(response.content)
-
-        # Транскрибируем аудио
-        transcription = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=(file_path, audio_file)  # Передаем имя файла и объект BytesIO
-        )
-
-        # Получаем транскрибированный текст
-        transcribed_text = transcription.text
+        # Скачиваем и транскрибируем аудио (или берем транскрипцию из контрольной точки)
+        transcribed_text = transcribe_audio(message, message.voice, 'voice')
 
         # Формируем сообщение пользователю: сначала подпись, потом транскрипция
         user_message = message.caption if message.caption else ""  # Получаем подпись
-        user_message = process_url_in_text(user_message, bot, chat_id)  # Обрабатываем URL в подписи, если он есть
+        user_message, cacheable = process_url_in_text(user_message, bot, chat_id)  # Обрабатываем URL в подписи, если он есть
         user_message += f"\nТранскрипция аудио: {transcribed_text}"  # Добавляем транскрипцию
 
     except Exception as e:
         logging.error(f"Ошибка при транскрибации аудио: {e}")
         bot.reply_to(message, "Произошла ошибка при транскрибации аудио.")
+        return
 
-    process_message(message, user_message, message_type, chat_id)
+    process_message(message, user_message, message_type, chat_id, cacheable=cacheable)
 
 
 # Обработка аудио сообщений
 @bot.message_handler(content_types=['audio'])
+@tracer.traced('handler')
 def handle_audio_message(message):
     chat_id = message.chat.id
     message_type = 'audio'
 
     try:
-        # Получаем информацию о файле
-        file_id = message.audio.file_id  # Изменено с message.voice.file_id на message.audio.file_id
-        file_info = bot.get_file(file_id)
-        file_path = file_info.file_path
-        file_url = f'https://api.telegram.org/file/bot{API_TOKEN}/{file_path}'
-
-        # Скачиваем файл
-        response = requests.get(file_url)
-        response.raise_for_status()  # Проверяем на ошибки
-
-        # Открываем файл как бинарный
-        audio_file = io.BytesIO(response.content)
-
-        # Транскрибируем аудио
-        transcription = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=(file_path, audio_file)  # Передаем имя файла и объект BytesIO
-        )
-
-        # Получаем транскрибированный текст
-        transcribed_text = transcription.text
+        # Скачиваем и транскрибируем аудио (или берем транскрипцию из контрольной точки)
+        transcribed_text = transcribe_audio(message, message.audio, 'audio')
 
          # Формируем сообщение пользователю: сначала подпись, потом транскрипция
         user_message = message.caption if message.caption else ""  # Получаем подпись
-        user_message = process_url_in_text(user_message, bot, chat_id) # Обрабатываем URL в подписи, если он есть
+        user_message, cacheable = process_url_in_text(user_message, bot, chat_id)  # Обрабатываем URL в подписи, если он есть
         user_message += f"\nТранскрипция аудио: {transcribed_text}"  # Добавляем транскрипцию
 
     except Exception as e:
         logging.error(f"Ошибка при транскрибации аудио: {e}")
         bot.reply_to(message, "Произошла ошибка при транскрибации аудио.")
+        return
 
-    process_message(message, user_message, message_type, chat_id)
+    process_message(message, user_message, message_type, chat_id, cacheable=cacheable)
 
 # Обработка опросов
 @bot.message_handler(content_types=['poll'])
+@tracer.traced('handler')
 def handle_poll_message(message):
     chat_id = message.chat.id
     user_message = f"Опрос: {message.poll.question}"
     message_type = 'poll'
     process_message(message, user_message, message_type, chat_id)
 
+# ===== Правки сообщений и постов (edited_message, edited_channel_post) =====
+# Правка обрабатывается тем же обработчиком, что и исходное сообщение: текст ссылок
+# и анализ медиа, которые не изменились, берутся из кеша, а ответ бота редактируется
+
+EDITED_CONTENT_TYPES = ['text', 'photo', 'document', 'video', 'voice', 'audio']
+
+@bot.edited_message_handler(content_types=EDITED_CONTENT_TYPES)
+@tracer.traced('handler')
+def handle_edited_message(message):
+    original = message_store.get(message.chat.id, message.message_id)
+    if original is None:
+        logging.info(f"Правка сообщения {message.message_id} без сохраненного ответа бота — пропускаем")
+        return
+
+    text = message.text or message.caption or ''
+    media_id = media_unique_id(message)
+    text_changed = text != original.text
+    media_changed = media_id != original.media_id
+    if not text_changed and not media_changed:
+        logging.info(f"Правка сообщения {message.message_id} не меняет текст и медиа — пропускаем")
+        return
+    logging.info(f"Правка сообщения {message.message_id}: текст {'изменен' if text_changed else 'без изменений'}, "
+                 f"медиа {'заменено' if media_changed else 'без изменений'}")
+
+    handler = {
+        'text': handle_text_message,
+        'photo': handle_photo_message,
+        'document': handle_pdf_message,
+        'video': handle_video_message,
+        'voice': handle_voice_message,
+        'audio': handle_audio_message,
+    }[message.content_type]
+    handler(message)
+
+@bot.edited_channel_post_handler(content_types=EDITED_CONTENT_TYPES)
+@tracer.traced('handler')
+def edited_channel_post(message):
+    handle_edited_message(message)
+
 # Функция для инициализации файла (создаем файл и пишем заголовки, если он не существует)
 def initialize_log_file():
     if not os.path.exists(file_path):
         with open(file_path, 'w', newline='', encoding='utf-8') as file:
             writer = csv.writer(file)
             writer.writerow(['chat_id', 'datetime', 'message', 'message_type', 'ai_response'])
+    # Однократный импорт существующего журнала в базу аналитики
+    try:
+        analytics.import_csv(file_path)
+    except Exception as e:
+        logging.error(f"Не удалось импортировать журнал в базу аналитики: {e}")
 
 # Функция для записи данных в файл
+@tracer.traced('log_write')
 def log_to_file(chat_id, user_message, message_type, ai_response):
     current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')  # Текущее время
     with open(file_path, 'a', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
         writer.writerow([chat_id, current_time, user_message, message_type, ai_response])
+    try:
+        analytics.record(chat_id, current_time, user_message, message_type, ai_response)
+    except Exception as e:
+        logging.warning(f"Не удалось записать взаимодействие в базу аналитики: {e}")
+
+def response_cache_key(user_message, message_type, media_id=None):
+    """
+    Ключ кеша ответов: хеш нормализованного полного текста запроса
+    (подпись, извлеченный текст ссылки, PDF или медиа), типа сообщения
+    и file_unique_id медиа — одинаковая подпись к разным файлам дает разные ключи.
+    """
+    normalized = " ".join(user_message.casefold().split())
+    return hashlib.sha256(f"{message_type}\n{media_id or ''}\n{normalized}".encode('utf-8')).hexdigest()
+
+# Системный промпт бота. Идет первым в каждом запросе: одинаковый префикс
+# позволяет провайдеру переиспользовать кеш промпта между запросами.
+SYSTEM_PROMPT = (
+    "Вы бот-администратор в телеграм-канале 'Это не канал'. Ваша задача — пересказывать на русском языке "
+    "подписчикам материалы, присылаемые в канал. Формируйте краткий (не более 3000 знаков) и интересный пересказ, "
+    "ориентируясь на следующие принципы:\n\n"
+    "1. Прочитайте пост. Если в посте указана ссылка, предположите, что она содержит дополнительную информацию. "
+    "Попробуйте дать пересказ, основываясь на теме, изложенной в посте, а также возможных контекстах.\n"
+    "2. Пересказ оформляйте структурно:\n"
+    "- Введение: кратко объясните, о чем материал и почему он важен.\n"
+    "- Основная часть: изложите ключевые моменты материала простым языком, подчеркивая суть. Разделяйте текст на абзацы.\n"
+    "- Заключение: сделайте выводы, предложите рекомендации или задайте вопрос для вовлечения подписчиков.\n"
+    "3. Если пост содержит только ссылку, составьте предположительный пересказ на основе общего контекста и доступной информации. "
+    "Укажите, что пересказ основан на интерпретации.\n"
+    "4. Указывайте источник информации в конце текста (например: 'Источник: ссылка из поста').\n\n"
+    "Общайтесь с читателями вежливо, от мужского лица, используя 'Вы'.\n\n"
+    "Включайте эмодзи для акцентирования ключевых моментов, таких как:\n"
+    "- 🔍 для выделения важных деталей,\n"
+    "- 📌 для ключевых тезисов,\n"
+    "- 🌟 для рекомендаций.\n\n"
+    "Следите за тем, чтобы текст был легко читаем на русском языке и не перегружен эмодзи. Старайтесь создавать увлекательные посты, чтобы подписчики захотели прочитать оригинал."
+)
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+def build_chat_messages(history):
+    """
+    Собирает запрос к модели: системный промпт, затем история разговора
+    (последний элемент — новое сообщение пользователя). Объекты сообщений
+    не копируются, поэтому префикс запроса совпадает от хода к ходу.
+    """
+    return [SYSTEM_MESSAGE, *history]
+
+def report_prompt_cache(chat_completion):
+    """Логирует, сколько токенов промпта провайдер взял из своего кеша."""
+    usage = getattr(chat_completion, 'usage', None)
+    if usage is None:
+        return
+    details = getattr(usage, 'prompt_tokens_details', None)
+    cached_tokens = getattr(details, 'cached_tokens', 0) or 0
+    logging.info(f"Токены промпта: {usage.prompt_tokens}, из кеша провайдера: {cached_tokens}")
+
+def remember_reply(message, message_type, user_message, reply_message_id):
+    """Сохраняет сообщение и ответ бота на него для последующей обработки правок."""
+    try:
+        message_store.remember(message.chat.id, message.message_id, message_type,
+                               message.text or message.caption or '', media_unique_id(message),
+                               user_message, reply_message_id)
+    except Exception as e:
+        logging.warning(f"Не удалось сохранить сообщение для обработки правок: {e}")
 
 # Общая функция для обработки сообщений
-def process_message(message, user_message, message_type, chat_id):
+def process_message(message, user_message, message_type, chat_id, cacheable=True):
+    # cacheable=False — запрос собран без части данных (извлечение не удалось или
+    # пропущено под нагрузкой); такой ответ не берется из кеша и не кешируется.
     # Проверяем, существует ли история для данного chat_id
     if chat_id not in conversation_history:
         conversation_history[chat_id] = []
 
+    # Ответ на этот апдейт уже отправлен до перезапуска — не дублируем его
+    if job_checkpoint(message, 'reply') is not None:
+        logging.info(f"Ответ на сообщение уже отправлен до перезапуска (Тип: {message_type})")
+        return
+
+    # Правка сообщения, на которое бот уже ответил: редактируем ответ на месте
+    if getattr(message, 'edit_date', None) is not None:
+        original = message_store.get(chat_id, message.message_id)
+        if original is not None:
+            process_edit(message, user_message, message_type, chat_id, original, cacheable)
+            return
+
+    # Одинаковый контент без значимой истории отвечаем из кеша, без запроса к API
+    cache_key = None
+    ai_response = None
+    if cacheable and len(conversation_history[chat_id]) <= RESPONSE_CACHE_MAX_HISTORY:
+        cache_key = response_cache_key(user_message, message_type, media_unique_id(message))
+        ai_response = response_cache.get(cache_key)
+
     # Добавляем сообщение пользователя в историю разговора
     conversation_history[chat_id].append({"role": "user", "content": user_message})
-    logging.info(f"Получено сообщение от пользователя: {user_message} (Тип: {message_type})")
+    logging.info(f"Получено сообщение от пользователя: {user_message} (Тип: {message_type}, trace: {tracer.current_trace_id()})")
     # Запрос к OpenAI с историей разговора
     try:
-        chat_completion = client.chat.completions.create(
-            model="gpt-3.5-turbo-1106",
-            messages=conversation_history[chat_id] + [
-                {"role": "system", "content": (
-                    "Вы бот-администратор в телеграм-канале 'Это не канал'. Ваша задача — пересказывать на русском языке "
-                    "подписчикам материалы, присылаемые в канал. Формируйте краткий (не более 3000 знаков) и интересный пересказ, "
-                    "ориентируясь на следующие принципы:\n\n"
-                    "1. Прочитайте пост. Если в посте указана ссылка, предположите, что она содержит дополнительную информацию. "
-                    "Попробуйте дать пересказ, основываясь на теме, изложенной в посте, а также возможных контекстах.\n"
-                    "2. Пересказ оформляйте структурно:\n"
-                    "- Введение: кратко объясните, о чем материал и почему он важен.\n"
-                    "- Основная часть: изложите ключевые моменты материала простым языком, подчеркивая суть. Разделяйте текст на абзацы.\n"
-                    "- Заключение: сделайте выводы, предложите рекомендации или задайте вопрос для вовлечения подписчиков.\n"
-                    "3. Если пост содержит только ссылку, составьте предположительный пересказ на основе общего контекста и доступной информации. "
-                    "Укажите, что пересказ основан на интерпретации.\n"
-                    "4. Указывайте источник информации в конце текста (например: 'Источник: ссылка из поста').\n\n"
-                    "Общайтесь с читателями вежливо, от мужского лица, используя 'Вы'.\n\n"
-                    "Включайте эмодзи для акцентирования ключевых моментов, таких как:\n"
-                    "- 🔍 для выделения важных деталей,\n"
-                    "- 📌 для ключевых тезисов,\n"
-                    "- 🌟 для рекомендаций.\n\n"
-                    "Следите за тем, чтобы текст был легко читаем на русском языке и не перегружен эмодзи. Старайтесь создавать увлекательные посты, чтобы подписчики захотели прочитать оригинал."
-                )},
-                {"role": "user", "content": user_message}
-            ]
-        )
-        # Получаем ответ от AI
-        ai_response = chat_completion.choices[0].message.content
-        bot.reply_to(message, ai_response)
+        if ai_response is not None:
+            logging.info(f"Ответ найден в кеше (Тип: {message_type})")
+            with tracer.span('reply', cached=True):
+                reply = bot.reply_to(message, ai_response)
+        else:
+            # Неизменный системный префикс, затем история (уже с новым сообщением) без дублирования
+            messages = build_chat_messages(conversation_history[chat_id])
+            chat_completion = model_router.complete(
+                client, 'chat', messages, input_text=user_message,
+            )
+            report_prompt_cache(chat_completion)
+            # Получаем ответ от AI
+            ai_response = chat_completion.choices[0].message.content
+            with tracer.span('reply'):
+                reply = bot.reply_to(message, ai_response)
+
+            if cache_key is not None and not truncated(chat_completion):
+                response_cache.set(cache_key, ai_response)
+        save_job_checkpoint(message, 'reply', ai_response)
+        remember_reply(message, message_type, user_message, reply.message_id)
 
         # Логирование данных в файл
         log_to_file(chat_id, user_message, message_type, ai_response)
@@ -779,6 +1204,59 @@ def process_message(message, user_message, message_type, chat_id):
         logging.error(f"Ошибка при обращении к OpenAI: {e}")
         bot.reply_to(message, "Извините, произошла ошибка при обработке вашего запроса.")
 
+def process_edit(message, user_message, message_type, chat_id, original, cacheable=True):
+    """
+    Обрабатывает правку: один запрос к модели с новым текстом вместо исходного
+    хода разговора и редактирование существующего ответа бота.
+    """
+    if user_message == original.request:
+        logging.info(f"Запрос после правки не изменился (Тип: {message_type}) — ответ оставляем")
+        remember_reply(message, message_type, user_message, original.reply_message_id)
+        return
+
+    # Исходный ход в истории заменяется, а не дублируется
+    history = conversation_history[chat_id]
+    index = next((i for i in range(len(history) - 1, -1, -1)
+                  if history[i]["role"] == "user" and history[i]["content"] == original.request), None)
+    context = history[:index] if index is not None else history
+    user_turn = {"role": "user", "content": user_message}
+    logging.info(f"Правка сообщения от пользователя: {user_message} (Тип: {message_type}, trace: {tracer.current_trace_id()})")
+
+    try:
+        cache_key = None
+        ai_response = None
+        if cacheable and len(context) <= RESPONSE_CACHE_MAX_HISTORY:
+            cache_key = response_cache_key(user_message, message_type, media_unique_id(message))
+            ai_response = response_cache.get(cache_key)
+        if ai_response is None:
+            chat_completion = model_router.complete(
+                client, 'chat', build_chat_messages([*context, user_turn]),
+                input_text=user_message,
+            )
+            report_prompt_cache(chat_completion)
+            ai_response = chat_completion.choices[0].message.content
+            if cache_key is not None and not truncated(chat_completion):
+                response_cache.set(cache_key, ai_response)
+
+        with tracer.span('reply', edited=True):
+            try:
+                bot.edit_message_text(ai_response, chat_id, original.reply_message_id)
+            except telebot.apihelper.ApiTelegramException as e:
+                # Модель вернула тот же текст — редактировать нечего
+                if 'message is not modified' not in str(e):
+                    raise
+        save_job_checkpoint(message, 'reply', ai_response)
+        remember_reply(message, message_type, user_message, original.reply_message_id)
+        log_to_file(chat_id, user_message, message_type, ai_response)
+
+        if index is not None:
+            history[index] = user_turn
+            if index + 1 < len(history) and history[index + 1]["role"] == "assistant":
+                history[index + 1] = {"role": "assistant", "content": ai_response}
+    except Exception as e:
+        logging.error(f"Ошибка при обработке правки сообщения: {e}")
+        bot.reply_to(message, "Извините, не удалось обновить ответ после правки сообщения.")
+
 # Запуск бота
 if __name__ == '__main__':
     initialize_log_file()  # Инициализация файла логов
@@ -787,12 +1265,9 @@ if __name__ == '__main__':
         bot.remove_webhook()
     except Exception:
         pass
-    # Явно указываем список типов апдейтов, чтобы бот получал посты из каналов
-    allowed_updates = [
-        "message",
-        "edited_message",
-        "channel_post",
-        "edited_channel_post",
-    ]
-    # Запускаем единичный polling и пропускаем накопившиеся апдейты
-    bot.infinity_polling(skip_pending=True, timeout=20, allowed_updates=allowed_updates)
+    # Продолжаем апдейты, не завершенные до перезапуска
+    bot.resume_jobs()
+    # Запускаем единичный polling; накопившиеся апдейты не пропускаем — они
+    # сохраняются в очередь, а уже обработанные отсеивает индекс повторов
+    # (многопроцессный режим запускается через supervisor.py)
+    bot.infinity_polling(skip_pending=False, timeout=20, allowed_updates=ALLOWED_UPDATES)
@@ -0,0 +1,104 @@
+"""
+Потокобезопасный кеш в файле SQLite с вытеснением LRU и истечением по времени.
+
+Кеш хранится на диске, поэтому он общий для всех рабочих процессов
+супервизора: одинаковый контент из чатов, закрепленных за разными
+процессами, тоже отвечается из кеша.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_cache_used_at ON cache (used_at);
+"""
+
+
+class SQLiteCache:
+    """
+    Кеш строк с ограничением по количеству записей (LRU) и времени жизни (TTL).
+
+    Args:
+        db_path (str): Путь к файлу SQLite.
+        maxsize (int): Максимальное количество записей.
+        ttl (float): Время жизни записи в секундах.
+    """
+
+    # Как часто (в секундах) удалять устаревшие и лишние записи
+    PURGE_INTERVAL = 60
+
+    def __init__(self, db_path, maxsize=256, ttl=3600):
+        self.db_path = db_path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT value FROM cache WHERE key = ? AND expires_at >= ?", (key, now)).fetchone()
+                if row is not None:
+                    self._conn.execute("UPDATE cache SET used_at = ? WHERE key = ?", (now, key))
+                    self._conn.commit()
+            except sqlite3.Error as e:
+                # Кеш — только оптимизация: при ошибке базы идем к модели
+                logging.warning(f"Ошибка чтения кеша {self.db_path}: {e}")
+                row = None
+            if row is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)",
+                    (key, value, now + self.ttl, now),
+                )
+                self._purge(now)
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"Ошибка записи в кеш {self.db_path}: {e}")
+
+    def pop(self, key, default=None):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND expires_at >= ?", (key, time.time())).fetchone()
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self._conn.commit()
+        return row[0] if row is not None else default
+
+    def _purge(self, now):
+        # Вызывается под self._lock
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        self._conn.execute("DELETE FROM cache WHERE expires_at < ?", (now,))
+        self._conn.execute(
+            "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,),
+        )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
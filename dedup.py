@@ -0,0 +1,101 @@
+"""
+Индекс уже обработанных апдейтов для защиты от повторной обработки.
+
+После перезапуска или сетевых повторов Telegram может прислать тот же
+update_id или тот же пост канала повторно. Индекс хранит ключи недавно
+обработанных апдейтов в SQLite-файле (работает и между процессами
+супервизора), записи устаревают через заданное время.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# Типы апдейтов с новыми сообщениями: для них дополнительно проверяем пару (chat_id, message_id)
+NEW_MESSAGE_KEYS = ("message", "channel_post")
+
+
+class UpdateIndex:
+    """
+    Персистентный индекс обработанных апдейтов с истечением по времени.
+
+    Args:
+        db_path (str): Путь к файлу SQLite.
+        ttl (int): Время хранения ключа в секундах.
+    """
+
+    def __init__(self, db_path, ttl=24 * 60 * 60):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._conn = sqlite3.connect(db_path, timeout=10, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS processed_updates ("
+            "key TEXT PRIMARY KEY, seen_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_processed_updates_seen_at ON processed_updates (seen_at)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def keys_for(update):
+        """Возвращает ключи, по которым апдейт считается дубликатом."""
+        keys = [f"update:{update.update_id}"]
+        for attr in NEW_MESSAGE_KEYS:
+            message = getattr(update, attr, None)
+            if message is not None:
+                keys.append(f"message:{message.chat.id}:{message.message_id}")
+        return keys
+
+    def check_and_mark(self, update):
+        """
+        Отмечает апдейт как обработанный.
+
+        Returns:
+            bool: True, если апдейт новый; False, если это дубликат.
+        """
+        keys = self.keys_for(update)
+        now = time.time()
+        with self._lock:
+            self._purge(now)
+            try:
+                placeholders = ",".join("?" * len(keys))
+                row = self._conn.execute(
+                    f"SELECT key FROM processed_updates WHERE key IN ({placeholders}) AND seen_at >= ?",
+                    (*keys, now - self.ttl),
+                ).fetchone()
+                if row:
+                    return False
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO processed_updates (key, seen_at) VALUES (?, ?)",
+                    [(key, now) for key in keys],
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                # Индекс — только оптимизация: при ошибке базы обрабатываем апдейт
+                logging.warning(f"Ошибка индекса обработанных апдейтов: {e}")
+        return True
+
+    def _purge(self, now):
+        # Чистим устаревшие ключи не чаще раза в минуту
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        try:
+            self._conn.execute("DELETE FROM processed_updates WHERE seen_at < ?", (now - self.ttl,))
+            self._conn.commit()
+        except sqlite3.Error as e:
+            logging.warning(f"Не удалось очистить индекс обработанных апдейтов: {e}")
+
+
+def open_update_index(logs_dir):
+    """Индекс повторов в папке журналов (общий для bot.py и supervisor.py)."""
+    return UpdateIndex(
+        os.path.join(logs_dir, 'processed_updates.sqlite3'),
+        ttl=int(os.getenv('DEDUP_TTL_SECONDS', 24 * 60 * 60)),
+    )
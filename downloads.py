@@ -0,0 +1,312 @@
+"""
+Общий менеджер загрузки файлов из Telegram.
+
+Все обработчики медиа скачивают файлы через один менеджер:
+- глобальное ограничение на число одновременных загрузок;
+- лимиты размера для каждого типа файла;
+- небольшие файлы остаются в памяти, крупные сбрасываются на диск
+  (spooled temp files), поэтому всплеск медиа не раздувает память;
+- одновременные запросы одного и того же file_id объединяются в одну загрузку;
+- временные файлы удаляются при ошибке и после использования;
+- крупные файлы можно сохранить в папку контрольных точек апдейта, чтобы
+  после перезапуска бота не скачивать их повторно.
+"""
+
+import contextlib
+import glob
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import requests
+
+MB = 1024 * 1024
+
+# Лимиты размера по типам файлов (Telegram Bot API не отдает файлы больше 20 MB)
+DEFAULT_SIZE_LIMITS = {
+    'photo': 10 * MB,
+    'video': 20 * MB,
+    'document': 20 * MB,
+    'audio': 20 * MB,
+    'voice': 20 * MB,
+}
+
+
+class DownloadTooLarge(Exception):
+    """Файл превышает лимит размера для своего типа."""
+
+    def __init__(self, kind, size, limit):
+        self.kind = kind
+        self.size = size
+        self.limit = limit
+        super().__init__(f"Файл типа {kind} слишком большой: {round(size / MB, 1)} MB (лимит {round(limit / MB, 1)} MB)")
+
+
+class DownloadedFile:
+    """
+    Скачанный файл: в памяти (BytesIO) или на диске.
+
+    Используется как контекстный менеджер; после выхода из последнего
+    контекста (с учетом объединенных запросов) временный файл удаляется.
+    """
+
+    def __init__(self, name, buffer=None, path=None, owned=True):
+        self.name = name
+        self._buffer = buffer
+        self.path = path
+        # Файлы из папки контрольных точек удаляет очередь апдейтов, а не этот объект
+        self._owns_path = path is not None and owned
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        if self._buffer is not None:
+            return self._buffer.getbuffer().nbytes
+        return os.path.getsize(self.path)
+
+    @property
+    def in_memory(self):
+        return self._buffer is not None
+
+    def open(self):
+        """Открывает содержимое файла для чтения (каждый вызов — независимый поток)."""
+        if self._buffer is not None:
+            return io.BytesIO(self._buffer.getbuffer())
+        return open(self.path, 'rb')
+
+    def read_bytes(self):
+        if self._buffer is not None:
+            return self._buffer.getvalue()
+        with open(self.path, 'rb') as file:
+            return file.read()
+
+    def as_path(self, suffix=''):
+        """Возвращает путь к файлу на диске, при необходимости сбрасывая его из памяти."""
+        with self._lock:
+            if self.path is None:
+                with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
+                    temp_file.write(self._buffer.getbuffer())
+                    self.path = temp_file.name
+                self._owns_path = True
+            return self.path
+
+    def acquire(self, count=1):
+        with self._lock:
+            self._refs += count
+        return self
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0:
+                return
+            self._buffer = None
+            if self.path and self._owns_path:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class _InFlight:
+    """Загрузка, которую ожидают несколько обработчиков."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.waiters = 0
+        self.result = None
+        self.error = None
+        # Папки контрольных точек ожидающих обработчиков и копии файла в них
+        self.checkpoint_dirs = []
+        self.copies = {}
+
+
+class DownloadManager:
+    """
+    Args:
+        bot (telebot.TeleBot): Экземпляр бота (для getFile).
+        token (str): Токен бота (для URL файла).
+        max_concurrent (int): Максимум одновременных загрузок.
+        spool_threshold (int): Размер в байтах, после которого файл сбрасывается на диск.
+        size_limits (dict): Лимиты размера по типам файлов.
+        timeout (int): Таймаут HTTP-запроса в секундах.
+        tracer (tracing.Tracer): Трассировщик для спанов загрузки (необязательно).
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, bot, token, max_concurrent=4, spool_threshold=5 * MB, size_limits=None, timeout=60,
+                 tracer=None):
+        self.bot = bot
+        self.token = token
+        self.tracer = tracer
+        self.spool_threshold = spool_threshold
+        self.size_limits = dict(DEFAULT_SIZE_LIMITS, **(size_limits or {}))
+        self.timeout = timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def check_size(self, kind, size):
+        limit = self.size_limits.get(kind)
+        if limit and size and size > limit:
+            raise DownloadTooLarge(kind, size, limit)
+
+    def file_url(self, file_id):
+        """Возвращает (URL файла, путь файла в Telegram)."""
+        file_info = self.bot.get_file(file_id)
+        return f'https://api.telegram.org/file/bot{self.token}/{file_info.file_path}', file_info.file_path
+
+    @staticmethod
+    def _checkpoint_path(checkpoint_dir, file_id):
+        safe_id = ''.join(c if c.isalnum() or c in '-_' else '_' for c in file_id)
+        return os.path.join(checkpoint_dir, safe_id)
+
+    def fetch(self, file_id, kind, file_size=None, suffix='', checkpoint_dir=None):
+        """
+        Скачивает файл (или присоединяется к уже идущей загрузке того же file_id).
+
+        Если указан checkpoint_dir, файл, сброшенный на диск, сохраняется в этой
+        папке, и повторный вызов (например, после перезапуска) берет его оттуда.
+        Небольшие файлы остаются в памяти и при необходимости скачиваются заново.
+
+        Returns:
+            DownloadedFile: файл, который нужно освободить (with ... или release()).
+
+        Raises:
+            DownloadTooLarge: если файл больше лимита для своего типа.
+        """
+        self.check_size(kind, file_size)
+
+        if checkpoint_dir:
+            saved = glob.glob(glob.escape(self._checkpoint_path(checkpoint_dir, file_id)) + '*')
+            if saved:
+                logging.info(f"Файл {file_id} взят из контрольной точки")
+                return DownloadedFile(os.path.basename(saved[0]), path=saved[0], owned=False)
+
+        with self._lock:
+            in_flight = self._in_flight.get(file_id)
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight[file_id] = _InFlight()
+            else:
+                in_flight.waiters += 1
+                in_flight.checkpoint_dirs.append(checkpoint_dir)
+
+        if not leader:
+            logging.info(f"Присоединяемся к загрузке файла {file_id}")
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.copies.get(checkpoint_dir) or in_flight.result
+
+        span = self.tracer.span('download', kind=kind, file_id=file_id) if self.tracer else contextlib.nullcontext()
+        try:
+            with span:
+                result = self._download(file_id, kind, suffix, checkpoint_dir)
+        except Exception as e:
+            in_flight.error = e
+            raise
+        else:
+            in_flight.result = result
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[file_id]
+            # Новые ожидающие больше не появятся: раскладываем файл по их контрольным точкам
+            shared = in_flight.waiters
+            if in_flight.result is not None and in_flight.result.path is not None:
+                for waiter_dir in in_flight.checkpoint_dirs:
+                    if waiter_dir and waiter_dir != checkpoint_dir:
+                        if waiter_dir not in in_flight.copies:
+                            in_flight.copies[waiter_dir] = self._save_copy(in_flight.result, file_id, waiter_dir)
+                        if in_flight.copies[waiter_dir] is not None:
+                            shared -= 1
+                in_flight.copies = {d: copy for d, copy in in_flight.copies.items() if copy is not None}
+            if in_flight.result is not None and shared:
+                in_flight.result.acquire(shared)
+            in_flight.done.set()
+
+    def _save_copy(self, downloaded, file_id, checkpoint_dir):
+        """
+        Кладет скачанный файл в папку контрольных точек другого апдейта
+        (жесткой ссылкой, а если не получилось — копией).
+
+        Returns:
+            DownloadedFile: файл в папке checkpoint_dir или None при ошибке.
+        """
+        saved_path = self._checkpoint_path(checkpoint_dir, file_id) + os.path.splitext(downloaded.path)[1]
+        try:
+            try:
+                os.link(downloaded.path, saved_path)
+            except FileExistsError:
+                pass
+            except OSError:
+                with tempfile.NamedTemporaryFile(delete=False, dir=checkpoint_dir) as temp_file:
+                    with open(downloaded.path, 'rb') as source:
+                        shutil.copyfileobj(source, temp_file)
+                os.replace(temp_file.name, saved_path)
+        except OSError as e:
+            logging.warning(f"Не удалось сохранить файл {file_id} в контрольную точку {checkpoint_dir}: {e}")
+            return None
+        return DownloadedFile(os.path.basename(saved_path), path=saved_path, owned=False)
+
+    def _download(self, file_id, kind, suffix, checkpoint_dir=None):
+        limit = self.size_limits.get(kind)
+        with self._semaphore:
+            url, telegram_path = self.file_url(file_id)
+            name = os.path.basename(telegram_path)
+            buffer = io.BytesIO()
+            temp_file = None
+            size = 0
+            try:
+                with requests.get(url, stream=True, timeout=self.timeout) as response:
+                    response.raise_for_status()
+                    self.check_size(kind, int(response.headers.get('Content-Length') or 0))
+                    for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                        if not chunk:
+                            continue
+                        size += len(chunk)
+                        if limit and size > limit:
+                            raise DownloadTooLarge(kind, size, limit)
+                        if temp_file is None and size > self.spool_threshold:
+                            # Файл крупный — переносим уже скачанное на диск
+                            temp_file = tempfile.NamedTemporaryFile(
+                                delete=False, suffix=suffix or os.path.splitext(name)[1], dir=checkpoint_dir)
+                            buffer.seek(0)
+                            shutil.copyfileobj(buffer, temp_file)
+                            buffer = None
+                        if temp_file is not None:
+                            temp_file.write(chunk)
+                        else:
+                            buffer.write(chunk)
+            except Exception:
+                if temp_file is not None:
+                    temp_file.close()
+                    try:
+                        os.unlink(temp_file.name)
+                    except OSError:
+                        pass
+                raise
+
+            if temp_file is not None:
+                temp_file.close()
+                logging.info(f"Файл {name} ({round(size / MB, 1)} MB) скачан на диск")
+                if checkpoint_dir:
+                    # Переименование атомарно: в контрольной точке не бывает недокачанных файлов
+                    saved_path = self._checkpoint_path(checkpoint_dir, file_id) + (suffix or os.path.splitext(name)[1])
+                    os.replace(temp_file.name, saved_path)
+                    return DownloadedFile(os.path.basename(saved_path), path=saved_path, owned=False)
+                return DownloadedFile(name, path=temp_file.name)
+            logging.info(f"Файл {name} ({round(size / MB, 2)} MB) скачан в память")
+            return DownloadedFile(name, buffer=buffer)
@@ -0,0 +1,208 @@
+"""
+Надежная очередь апдейтов, переживающая перезапуски бота.
+
+Апдейт записывается в локальную базу SQLite до того, как Telegram получит
+подтверждение (следующий getUpdates со смещением). Завершенные этапы
+обработки — загрузки, транскрипции, извлеченный текст, ответы моделей —
+сохраняются как контрольные точки. После перезапуска незавершенные апдейты
+возвращаются в обработку и продолжаются с последнего завершенного этапа,
+а не теряются и не оплачиваются повторно.
+"""
+
+import functools
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+# Типы апдейтов, которые сохраняются в очередь
+QUEUED_UPDATE_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    update_id INTEGER PRIMARY KEY,
+    chat_id INTEGER,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, update_id);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    update_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (update_id, stage)
+);
+"""
+
+
+def raw_update(update):
+    """Восстанавливает сырой JSON апдейта из объекта telebot."""
+    raw = {'update_id': update.update_id}
+    for key in QUEUED_UPDATE_KEYS:
+        message = getattr(update, key, None)
+        if message is not None:
+            raw[key] = message.json
+    return raw
+
+
+def raw_chat_id(raw):
+    for key in QUEUED_UPDATE_KEYS:
+        message = raw.get(key)
+        if message and 'chat' in message:
+            return message['chat']['id']
+    return None
+
+
+class JobQueue:
+    """
+    Args:
+        db_path (str): Путь к файлу SQLite.
+        files_root (str): Папка для контрольных точек загрузок (по папке на апдейт).
+        max_attempts (int): Сколько раз апдейт возвращается в обработку после перезапусков.
+    """
+
+    # Сколько секунд хранить записи апдейтов, исчерпавших попытки (для разбора ошибок)
+    FAILED_TTL = 7 * 24 * 60 * 60
+
+    def __init__(self, db_path, files_root, max_attempts=3):
+        self.db_path = db_path
+        self.files_root = files_root
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            cursor = self._conn.execute(sql, params)
+            self._conn.commit()
+            return cursor
+
+    def enqueue(self, raw):
+        """
+        Сохраняет апдейт в очередь (повторная запись того же update_id игнорируется).
+
+        Returns:
+            bool: True, если апдейт записан впервые.
+        """
+        now = time.time()
+        cursor = self._execute(
+            "INSERT OR IGNORE INTO jobs (update_id, chat_id, payload, status, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'pending', ?, ?)",
+            (raw['update_id'], raw_chat_id(raw), json.dumps(raw, ensure_ascii=False), now, now),
+        )
+        return cursor.rowcount > 0
+
+    def set_status(self, update_id, status, error=None):
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE update_id = ?",
+            (status, error, time.time(), update_id),
+        )
+
+    def complete(self, update_id):
+        """Удаляет завершенный апдейт вместе с его контрольными точками и файлами."""
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE update_id = ?", (update_id,))
+            self._conn.execute("DELETE FROM jobs WHERE update_id = ?", (update_id,))
+            self._conn.commit()
+        shutil.rmtree(os.path.join(self.files_root, str(update_id)), ignore_errors=True)
+
+    def fail(self, update_id, error):
+        """Отмечает ошибку; апдейт останется в очереди до исчерпания попыток."""
+        self.set_status(update_id, 'pending', error=str(error)[:1000])
+
+    def track(self, task, update_id):
+        """Оборачивает задачу обработчика: по завершении апдейт удаляется из очереди, при ошибке остается."""
+        @functools.wraps(task)
+        def wrapper(*args, **kwargs):
+            try:
+                result = task(*args, **kwargs)
+            except Exception as e:
+                self.fail(update_id, e)
+                raise
+            self.complete(update_id)
+            return result
+        return wrapper
+
+    def pending_ids(self):
+        """Список (update_id, chat_id) незавершенных апдейтов."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT update_id, chat_id FROM jobs WHERE status IN ('pending', 'deferred') ORDER BY update_id"
+            ).fetchall()
+
+    def take_resumable(self, update_ids=None):
+        """
+        Возвращает незавершенные апдейты (сырые) для повторной обработки после
+        перезапуска и увеличивает их счетчик попыток. Апдейты, исчерпавшие
+        попытки, помечаются failed и больше не возвращаются; их контрольные
+        точки и файлы удаляются сразу, а записи — через FAILED_TTL.
+
+        Args:
+            update_ids (set): Вернуть только эти апдейты (по умолчанию — все).
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT update_id, payload, attempts FROM jobs WHERE status IN ('pending', 'deferred') "
+                "ORDER BY update_id"
+            ).fetchall()
+            resumable = []
+            failed = []
+            now = time.time()
+            for update_id, payload, attempts in rows:
+                if update_ids is not None and update_id not in update_ids:
+                    continue
+                if attempts >= self.max_attempts:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'failed', updated_at = ? WHERE update_id = ?", (now, update_id))
+                    self._conn.execute("DELETE FROM checkpoints WHERE update_id = ?", (update_id,))
+                    failed.append(update_id)
+                    logging.error(f"Апдейт {update_id} не обработан за {attempts} попыток и исключен из очереди")
+                    continue
+                self._conn.execute(
+                    "UPDATE jobs SET attempts = attempts + 1, updated_at = ? WHERE update_id = ?", (now, update_id))
+                resumable.append(json.loads(payload))
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status = 'failed' AND updated_at < ?", (now - self.FAILED_TTL,))
+            self._conn.commit()
+        for update_id in failed:
+            shutil.rmtree(os.path.join(self.files_root, str(update_id)), ignore_errors=True)
+        return resumable
+
+    def get_checkpoint(self, update_id, stage):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM checkpoints WHERE update_id = ? AND stage = ?", (update_id, stage)
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_checkpoint(self, update_id, stage, value):
+        self._execute(
+            "INSERT OR REPLACE INTO checkpoints (update_id, stage, value, created_at) VALUES (?, ?, ?, ?)",
+            (update_id, stage, value, time.time()),
+        )
+
+    def files_dir(self, update_id):
+        """Папка для сохраненных загрузок апдейта (создается при необходимости)."""
+        path = os.path.join(self.files_root, str(update_id))
+        os.makedirs(path, exist_ok=True)
+        return path
+
+
+def open_job_queue(logs_dir):
+    """Очередь апдейтов в папке журналов (общая для bot.py и supervisor.py)."""
+    return JobQueue(
+        os.path.join(logs_dir, 'jobs.sqlite3'),
+        os.path.join(logs_dir, 'job_files'),
+        max_attempts=int(os.getenv('JOB_MAX_ATTEMPTS', 3)),
+    )
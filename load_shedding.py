@@ -0,0 +1,123 @@
+"""
+Управление нагрузкой: постепенная деградация качества при очереди апдейтов.
+
+Уровень нагрузки вычисляется по глубине очереди (апдейты, принятые к
+обработке, но еще не завершенные, в том числе ожидающие во внешних очередях,
+например в полосах рабочего процесса супервизора) и по сглаженной задержке
+обработки.
+Чем выше уровень, тем дешевле обработка:
+
+    FULL           — полная обработка;
+    REDUCED        — уменьшенный max_tokens у промежуточных этапов (фото, PDF, видео);
+    NO_HEAVY_MEDIA — без Vision для фото и без прямого анализа видео в Gemini;
+    FAST_MODELS    — в первую очередь самые быстрые и дешевые модели;
+    DEFER          — новые апдейты откладываются с ответом «обработаю позже».
+
+Уровень повышается сразу, а понижается по одной ступени после того, как
+нагрузка продержалась ниже текущего уровня recovery_seconds секунд.
+"""
+
+import functools
+import logging
+import threading
+import time
+
+FULL, REDUCED, NO_HEAVY_MEDIA, FAST_MODELS, DEFER = range(5)
+
+LEVEL_NAMES = {
+    FULL: 'полная обработка',
+    REDUCED: 'сокращенные ответы',
+    NO_HEAVY_MEDIA: 'без тяжелого анализа медиа',
+    FAST_MODELS: 'быстрые модели',
+    DEFER: 'отложенная обработка',
+}
+
+
+class LoadShedder:
+    """
+    Args:
+        depth_thresholds (tuple): Глубина очереди, с которой включаются уровни REDUCED..DEFER.
+        latency_target (float): Целевая задержка обработки апдейта в секундах.
+        recovery_seconds (float): Сколько нагрузка должна быть ниже уровня, чтобы опустить его на ступень.
+    """
+
+    EWMA_ALPHA = 0.2
+    # Задержка без свежих замеров перестает влиять на уровень
+    LATENCY_STALE_SECONDS = 60
+
+    def __init__(self, depth_thresholds=(4, 8, 16, 32), latency_target=30.0, recovery_seconds=30.0):
+        self.depth_thresholds = tuple(depth_thresholds)
+        self.latency_target = latency_target
+        self.recovery_seconds = recovery_seconds
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._backlog = 0
+        self._latency = None
+        self._latency_at = 0.0
+        self._level = FULL
+        self._calm_since = None
+
+    @property
+    def pending(self):
+        return self._pending + self._backlog
+
+    def enqueued(self):
+        """Апдейт поставлен во внешнюю очередь и ждет, пока до него дойдет обработчик."""
+        with self._lock:
+            self._backlog += 1
+
+    def dequeued(self):
+        """Апдейт забран из внешней очереди на обработку."""
+        with self._lock:
+            self._backlog = max(0, self._backlog - 1)
+
+    def track(self, task):
+        """Оборачивает задачу обработчика: учитывает ее в очереди и замеряет задержку."""
+        submitted = time.monotonic()
+        with self._lock:
+            self._pending += 1
+
+        @functools.wraps(task)
+        def wrapper(*args, **kwargs):
+            try:
+                return task(*args, **kwargs)
+            finally:
+                self._finish(time.monotonic() - submitted)
+        return wrapper
+
+    def _finish(self, latency):
+        with self._lock:
+            self._pending = max(0, self._pending - 1)
+            self._latency = latency if self._latency is None else (
+                self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * self._latency)
+            self._latency_at = time.monotonic()
+
+    def _pressure(self, now):
+        depth = self._pending + self._backlog
+        depth_level = sum(1 for threshold in self.depth_thresholds if depth >= threshold)
+        latency_level = FULL
+        if self._latency is not None and now - self._latency_at < self.LATENCY_STALE_SECONDS:
+            ratio = self._latency / self.latency_target
+            # Задержка сама по себе не доводит до отложенной обработки
+            latency_level = min(FAST_MODELS, sum(1 for bound in (1.0, 1.5, 2.0) if ratio >= bound))
+        return max(depth_level, latency_level)
+
+    def level(self):
+        """Текущий уровень деградации."""
+        now = time.monotonic()
+        with self._lock:
+            pressure = self._pressure(now)
+            previous = self._level
+            if pressure >= self._level:
+                self._level = pressure
+                self._calm_since = None
+            elif self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= self.recovery_seconds:
+                self._level -= 1
+                self._calm_since = now if pressure < self._level else None
+            level = self._level
+        if level != previous:
+            logging.warning(f"Уровень нагрузки: {LEVEL_NAMES[level]} (очередь {self.pending}, "
+                            f"задержка {self._latency or 0:.1f} с)")
+        return level
@@ -0,0 +1,112 @@
+"""
+Хранилище обработанных сообщений и результатов извлечения для обработки правок.
+
+Для каждого сообщения, на которое бот ответил, сохраняются исходный текст или
+подпись, идентификатор медиа (file_unique_id), собранный запрос к модели и
+message_id ответа бота. Отдельно кешируются результаты дорогих этапов: текст
+страниц по URL и анализ медиа по file_unique_id. При правке сообщения
+сравнивается новый текст с сохраненным, неизменившиеся части берутся из кеша,
+и существующий ответ бота редактируется на месте.
+"""
+
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+StoredMessage = namedtuple('StoredMessage', ['message_type', 'text', 'media_id', 'request', 'reply_message_id'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    message_type TEXT NOT NULL,
+    text TEXT NOT NULL,
+    media_id TEXT,
+    request TEXT NOT NULL,
+    reply_message_id INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+CREATE TABLE IF NOT EXISTS extractions (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_updated_at ON messages (updated_at);
+CREATE INDEX IF NOT EXISTS idx_extractions_created_at ON extractions (created_at);
+"""
+
+
+class MessageStore:
+    """
+    Args:
+        db_path (str): Путь к файлу SQLite.
+        ttl (int): Сколько секунд хранить сообщения и результаты извлечения.
+    """
+
+    PURGE_INTERVAL = 60 * 60
+
+    def __init__(self, db_path, ttl=7 * 24 * 60 * 60):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.commit()
+
+    def _purge(self, now):
+        # Вызывается под self._lock
+        if now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        self._conn.execute("DELETE FROM messages WHERE updated_at < ?", (now - self.ttl,))
+        self._conn.execute("DELETE FROM extractions WHERE created_at < ?", (now - self.ttl,))
+
+    def get(self, chat_id, message_id):
+        """Сохраненное сообщение или None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT message_type, text, media_id, request, reply_message_id FROM messages "
+                "WHERE chat_id = ? AND message_id = ? AND updated_at >= ?",
+                (chat_id, message_id, time.time() - self.ttl),
+            ).fetchone()
+        return StoredMessage(*row) if row else None
+
+    def remember(self, chat_id, message_id, message_type, text, media_id, request, reply_message_id):
+        """Сохраняет (или обновляет после правки) обработанное сообщение и ответ бота на него."""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO messages "
+                "(chat_id, message_id, message_type, text, media_id, request, reply_message_id, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, message_id, message_type, text, media_id, request, reply_message_id, now),
+            )
+            self._purge(now)
+            self._conn.commit()
+
+    def get_extraction(self, key, max_age=None):
+        """
+        Результат извлечения по ключу (например, 'url:<адрес>' или
+        'transcript:<file_unique_id>') не старше max_age секунд (по умолчанию ttl).
+        """
+        max_age = self.ttl if max_age is None else max_age
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM extractions WHERE key = ? AND created_at >= ?",
+                (key, time.time() - max_age),
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_extraction(self, key, value):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO extractions (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, now),
+            )
+            self._purge(now)
+            self._conn.commit()
@@ -0,0 +1,260 @@
+"""
+Маршрутизатор моделей: выбирает модель и max_tokens для каждого запроса.
+
+Выбор зависит от задачи (тип контента), оценки количества входных токенов,
+бюджета по задержке и стоимости. Маршрутизатор следит за задержкой (отдельно
+для каждой задачи) и ошибками каждой модели: модели медленнее бюджета задачи
+уходят в конец списка, модели с серией ошибок временно исключаются, а вызов
+автоматически переходит к следующей модели. Устаревший замер задержки перестает
+понижать модель, поэтому она снова пробуется и может вернуться в начало списка.
+Все решения и замеры пишутся в CSV для последующей настройки политики.
+"""
+
+import contextlib
+import csv
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from load_shedding import FAST_MODELS, FULL, REDUCED
+
+# Описание модели: окно контекста и примерная цена (USD за 1M токенов)
+ModelSpec = namedtuple('ModelSpec', ['context', 'input_price', 'output_price'])
+
+MODELS = {
+    'gpt-3.5-turbo-1106': ModelSpec(16385, 1.0, 2.0),
+    'gpt-4o-mini': ModelSpec(128000, 0.15, 0.6),
+    'gpt-4o': ModelSpec(128000, 2.5, 10.0),
+    'gemini-1.5-pro': ModelSpec(2000000, 1.25, 5.0),
+    'gemini-1.5-flash': ModelSpec(1000000, 0.075, 0.3),
+}
+
+# Кандидаты для каждой задачи в порядке предпочтения
+ROUTES = {
+    'chat': ['gpt-3.5-turbo-1106', 'gpt-4o-mini'],
+    'vision': ['gpt-4o-mini', 'gpt-4o'],
+    'pdf': ['gpt-4o-mini', 'gpt-3.5-turbo-1106'],
+    'video_fallback': ['gpt-4o-mini', 'gpt-3.5-turbo-1106'],
+    'video': ['gemini-1.5-pro', 'gemini-1.5-flash'],
+}
+
+# Бюджет задержки по задачам в секундах: анализ видео и длинных PDF заведомо дольше чата
+DEFAULT_LATENCY_BUDGETS = {
+    'chat': 30.0,
+    'vision': 30.0,
+    'pdf': 60.0,
+    'video_fallback': 60.0,
+    'video': 120.0,
+}
+
+# Пересказ по системному промпту — до 3000 знаков русского текста. Для кириллицы
+# токенизатор дает ~2 знака на токен, плюс запас на разметку и эмодзи
+SUMMARY_MAX_CHARS = 3000
+CYRILLIC_CHARS_PER_TOKEN = 2
+CHAT_MAX_TOKENS = SUMMARY_MAX_CHARS // CYRILLIC_CHARS_PER_TOKEN + 200
+
+Route = namedtuple('Route', ['task', 'model', 'max_tokens', 'input_tokens'])
+
+
+def estimate_tokens(text):
+    """Грубая оценка количества токенов (для кириллицы ~3 символа на токен)."""
+    return len(text or "") // 3 + 1
+
+
+def max_tokens_for(task):
+    """Размер ответа в зависимости от задачи."""
+    if task == 'vision':
+        return 300
+    if task == 'pdf':
+        return 500
+    if task == 'video_fallback':
+        return 700
+    if task == 'video':
+        return None
+    # Пересказ: лимит рассчитан на целевой объем, короткий пост и так даст короткий ответ
+    return CHAT_MAX_TOKENS
+
+
+def truncated(response):
+    """True, если ответ модели обрезан по max_tokens (такой ответ не кешируется)."""
+    choices = getattr(response, 'choices', None) or []
+    return bool(choices) and getattr(choices[0], 'finish_reason', None) == 'length'
+
+
+class ModelRouter:
+    """
+    Выбор модели и max_tokens с учетом бюджета и состояния моделей.
+
+    Args:
+        stats_path (str): CSV-файл для записи решений и замеров.
+        latency_budgets (dict): Бюджеты задержки по задачам (поверх DEFAULT_LATENCY_BUDGETS).
+        max_cost (float): Максимальная оценочная стоимость запроса в USD (0 — без ограничения).
+        timeout (float): Таймаут одного вызова модели в секундах.
+        tracer (tracing.Tracer): Трассировщик для спанов вызова модели (необязательно).
+        load_level (callable): Возвращает текущий уровень нагрузки (load_shedding);
+            под нагрузкой ответы сокращаются, а быстрые модели идут первыми.
+    """
+
+    FAILURE_THRESHOLD = 3
+    COOLDOWN_SECONDS = 60
+    EWMA_ALPHA = 0.3
+    # Через сколько секунд без новых замеров медленная модель пробуется снова
+    LATENCY_STALE_SECONDS = 300
+
+    def __init__(self, stats_path, latency_budgets=None, max_cost=0.0, timeout=120.0, tracer=None, load_level=None):
+        self.stats_path = stats_path
+        self.tracer = tracer
+        self.load_level = load_level
+        self.latency_budgets = dict(DEFAULT_LATENCY_BUDGETS, **(latency_budgets or {}))
+        self.max_cost = max_cost
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        # Задержка хранится по (задача, модель): долгий PDF не замедляет ту же модель в чате
+        self._latency = {}
+        self._latency_at = {}
+        self._failures = {}
+        self._open_until = {}
+        self._initialize_stats_file()
+
+    def _initialize_stats_file(self):
+        if not os.path.exists(self.stats_path):
+            with open(self.stats_path, 'w', newline='', encoding='utf-8') as file:
+                writer = csv.writer(file)
+                writer.writerow(['datetime', 'task', 'model', 'max_tokens', 'input_tokens',
+                                 'latency', 'status', 'prompt_tokens', 'completion_tokens', 'cached_tokens'])
+
+    def estimated_cost(self, model, input_tokens, max_tokens):
+        spec = MODELS[model]
+        output_tokens = max_tokens or 1000
+        return (input_tokens * spec.input_price + output_tokens * spec.output_price) / 1_000_000
+
+    def route(self, task, input_text="", prompt_tokens=None):
+        """
+        Возвращает список маршрутов (модель + max_tokens) в порядке попыток.
+
+        Размер ответа задается задачей, а проверка контекста и стоимости
+        идет по всему запросу (prompt_tokens, если задан, иначе input_text).
+        Модели, которые не помещают запрос в контекст или выходят за бюджет
+        стоимости, отбрасываются; модели с открытым «предохранителем» и
+        модели медленнее бюджета задачи (по свежему замеру) переносятся в
+        конец как запасные.
+        """
+        max_tokens = max_tokens_for(task)
+        input_tokens = prompt_tokens or estimate_tokens(input_text)
+        now = time.monotonic()
+
+        load_level = self.load_level() if self.load_level else FULL
+        # Пересказ не сокращаем: модель не знает о лимите и обрывает ответ на полуслове.
+        # Сокращаются промежуточные этапы (описание фото, анализ PDF и видео)
+        if load_level >= REDUCED and max_tokens and task != 'chat':
+            max_tokens = max(150, max_tokens // 2)
+
+        budget = self.latency_budgets.get(task)
+        preferred, fallback = [], []
+        for model in ROUTES[task]:
+            spec = MODELS[model]
+            if input_tokens + (max_tokens or 0) > spec.context:
+                continue
+            if self.max_cost and self.estimated_cost(model, input_tokens, max_tokens) > self.max_cost:
+                continue
+            route = Route(task, model, max_tokens, input_tokens)
+            with self._lock:
+                open_until = self._open_until.get(model)
+                if open_until is not None and open_until <= now:
+                    # Время исключения истекло — счетчик ошибок начинается заново
+                    del self._open_until[model]
+                    self._failures[model] = 0
+                    logging.info(f"Модель {model} возвращена в маршрутизацию")
+                unhealthy = model in self._open_until
+                key = (task, model)
+                fresh = now - self._latency_at.get(key, 0) < self.LATENCY_STALE_SECONDS
+                slow = bool(budget) and fresh and self._latency.get(key, 0) > budget
+            (fallback if unhealthy or slow else preferred).append(route)
+
+        if load_level >= FAST_MODELS:
+            # Под высокой нагрузкой первыми идут самые дешевые (и быстрые) модели
+            preferred.sort(key=lambda route: MODELS[route.model].output_price)
+        routes = preferred + fallback
+        if not routes:
+            # Ничего не подошло по бюджету — берем последнюю модель задачи как есть
+            routes = [Route(task, ROUTES[task][-1], max_tokens, input_tokens)]
+        return routes
+
+    def record(self, route, latency, ok, usage=None):
+        """Обновляет статистику модели и записывает решение в CSV."""
+        with self._lock:
+            if ok:
+                key = (route.task, route.model)
+                now = time.monotonic()
+                previous = self._latency.get(key)
+                if previous is not None and now - self._latency_at[key] >= self.LATENCY_STALE_SECONDS:
+                    # Устаревший замер не смешиваем с новым: модель оценивается заново
+                    previous = None
+                self._latency[key] = latency if previous is None else (
+                    self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * previous)
+                self._latency_at[key] = now
+                self._failures[route.model] = 0
+            else:
+                failures = self._failures.get(route.model, 0) + 1
+                self._failures[route.model] = failures
+                if failures >= self.FAILURE_THRESHOLD:
+                    self._open_until[route.model] = time.monotonic() + self.COOLDOWN_SECONDS
+                    logging.warning(f"Модель {route.model} временно исключена после {failures} ошибок подряд")
+
+            prompt_tokens = getattr(usage, 'prompt_tokens', '') if usage else ''
+            completion_tokens = getattr(usage, 'completion_tokens', '') if usage else ''
+            details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+            cached_tokens = getattr(details, 'cached_tokens', '') if details else ''
+            try:
+                with open(self.stats_path, 'a', newline='', encoding='utf-8') as file:
+                    writer = csv.writer(file)
+                    writer.writerow([
+                        datetime.now().strftime('%Y-%m-%d %H:%M:%S'), route.task, route.model,
+                        route.max_tokens, route.input_tokens, f"{latency:.3f}",
+                        'ok' if ok else 'error', prompt_tokens, completion_tokens, cached_tokens,
+                    ])
+            except OSError as e:
+                logging.warning(f"Не удалось записать статистику маршрутизации: {e}")
+
+    def span(self, route):
+        """Спан вызова модели (или пустой контекст, если трассировка не подключена)."""
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span('model_call', task=route.task, model=route.model, max_tokens=route.max_tokens)
+
+    def complete(self, client, task, messages, input_text="", **kwargs):
+        """
+        Выполняет chat completion через OpenAI-клиент с автоматическим
+        переходом к следующей модели при ошибке.
+        """
+        prompt_tokens = sum(
+            estimate_tokens(m["content"]) for m in messages if isinstance(m.get("content"), str))
+        last_error = None
+        for route in self.route(task, input_text, prompt_tokens=prompt_tokens or None):
+            started = time.monotonic()
+            try:
+                params = dict(model=route.model, messages=messages, timeout=self.timeout, **kwargs)
+                if route.max_tokens:
+                    params['max_tokens'] = route.max_tokens
+                with self.span(route) as span:
+                    response = client.chat.completions.create(**params)
+                    usage = getattr(response, 'usage', None)
+                    if span is not None and usage is not None:
+                        details = getattr(usage, 'prompt_tokens_details', None)
+                        span.set_attribute('prompt_tokens', getattr(usage, 'prompt_tokens', None))
+                        span.set_attribute('cached_tokens', getattr(details, 'cached_tokens', None))
+            except Exception as e:
+                self.record(route, time.monotonic() - started, ok=False)
+                logging.warning(f"Модель {route.model} ({task}) не ответила: {e}")
+                last_error = e
+                continue
+            self.record(route, time.monotonic() - started, ok=True, usage=getattr(response, 'usage', None))
+            logging.info(f"Маршрут {task}: {route.model}, max_tokens={route.max_tokens}, "
+                         f"{time.monotonic() - started:.1f} с")
+            if truncated(response):
+                logging.warning(f"Ответ модели {route.model} ({task}) обрезан по max_tokens={route.max_tokens}")
+            return response
+        raise last_error
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Воспроизведение нагрузки из журнала взаимодействий (logs/telegram_bot_logs.csv).
+
+Каждая строка журнала превращается в апдейт Telegram со своей меткой времени
+и прогоняется через настоящие обработчики бота. Внешние вызовы (OpenAI,
+Gemini, Telegram, загрузка страниц и файлов) подменяются: чат-модель
+возвращает записанный в журнале ответ, если вход совпал, иначе — синтетический.
+Время между сообщениями можно сжать (--speedup 10, --speedup 100), чтобы
+проверить бота под нагрузкой в 10–100 раз выше реальной.
+
+В конце печатается задержка и пропускная способность по типам сообщений.
+
+Запуск:
+    python replay_log.py logs/telegram_bot_logs.csv --speedup 100 --concurrency 8
+"""
+
+import argparse
+import base64
+import csv
+import io
+import itertools
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+TraceEntry = namedtuple('TraceEntry', ['timestamp', 'chat_id', 'message', 'message_type', 'ai_response'])
+
+# Типы, которые бот обрабатывает и в постах каналов
+CHANNEL_TYPES = ('text', 'photo', 'document', 'video')
+
+# Ответы бота, которые означают, что сообщение не обработано
+ERROR_REPLY_PREFIXES = ('Ошибка', 'Произошла ошибка', 'Извините, произошла ошибка', 'Не удалось', '⚠️')
+
+# Синтетический размер файлов в апдейтах (бот проверяет лимиты до загрузки)
+REPLAY_FILE_SIZE = 1024
+
+
+def load_trace(csv_path, limit=None):
+    """Читает журнал и возвращает записи, упорядоченные по времени."""
+    entries = []
+    with open(csv_path, newline='', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            try:
+                timestamp = datetime.strptime(row['datetime'], '%Y-%m-%d %H:%M:%S')
+                chat_id = int(row['chat_id'])
+            except (KeyError, ValueError):
+                continue
+            entries.append(TraceEntry(timestamp, chat_id, row.get('message') or '',
+                                      row.get('message_type') or 'text', row.get('ai_response') or ''))
+    entries.sort(key=lambda entry: entry.timestamp)
+    return entries[:limit] if limit else entries
+
+
+def build_update(update_id, entry):
+    """Собирает сырой апдейт Telegram (dict) для записи журнала."""
+    is_channel = str(entry.chat_id).startswith('-100') and entry.message_type in CHANNEL_TYPES
+    message = {
+        'message_id': update_id,
+        'date': int(entry.timestamp.timestamp()),
+        'chat': {'id': entry.chat_id, 'type': 'channel' if is_channel else ('private' if entry.chat_id > 0 else 'supergroup')},
+    }
+    if not is_channel:
+        message['from'] = {'id': abs(entry.chat_id), 'is_bot': False, 'first_name': 'Replay'}
+
+    file_id = f"replay-{update_id}"
+    media = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': REPLAY_FILE_SIZE}
+    # В журнал пишется собранный запрос (подпись + извлеченный текст), берем исходную часть
+    caption = entry.message.split('\n')[0]
+
+    if entry.message_type == 'text':
+        message['text'] = entry.message.split('\n\n')[0] or ' '
+    elif entry.message_type == 'photo':
+        message['photo'] = [dict(media, width=1280, height=720)]
+        message['caption'] = caption
+    elif entry.message_type == 'document':
+        message['document'] = dict(media, file_name='replay.pdf', mime_type='application/pdf')
+        message['caption'] = caption
+    elif entry.message_type == 'video':
+        message['video'] = dict(media, width=1280, height=720, duration=10)
+        message['caption'] = caption
+    elif entry.message_type in ('voice', 'audio'):
+        message[entry.message_type] = dict(media, duration=10)
+    elif entry.message_type == 'poll':
+        message['poll'] = {
+            'id': file_id, 'question': caption.replace('Опрос: ', '', 1), 'options': [],
+            'total_voter_count': 0, 'is_closed': False, 'is_anonymous': True,
+            'type': 'regular', 'allows_multiple_answers': False,
+        }
+    else:
+        message['text'] = entry.message or ' '
+
+    return {'update_id': update_id, 'channel_post' if is_channel else 'message': message}
+
+
+def minimal_pdf(text):
+    """Одностраничный PDF с текстом (чтобы PdfReader в боте извлекал текст)."""
+    stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode('latin-1')
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+        b"/Resources << /Font << /F1 4 0 R >> >> /Contents 5 0 R >>",
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream),
+    ]
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return pdf
+
+
+class FailureCounter(logging.Handler):
+    """
+    Считает сбои обработчиков в текущем потоке: ошибки в журнале бота и ответы
+    пользователю с текстом ошибки (обработчики перехватывают исключения сами).
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self._local = threading.local()
+
+    def _failures(self):
+        if not hasattr(self._local, 'failures'):
+            self._local.failures = []
+        return self._local.failures
+
+    def emit(self, record):
+        self._failures().append(record.getMessage())
+
+    def check_reply(self, text):
+        if isinstance(text, str) and text.startswith(ERROR_REPLY_PREFIXES):
+            self._failures().append(text)
+
+    def take(self):
+        """Сбои, накопленные в текущем потоке с прошлого вызова."""
+        failures = self._failures()
+        self._local.failures = []
+        return failures
+
+
+failures = FailureCounter()
+
+
+def _completion(content):
+    usage = SimpleNamespace(prompt_tokens=0, completion_tokens=0,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=0))
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+
+class FakeOpenAI:
+    """Подмена OpenAI-клиента: записанные ответы из журнала или синтетические."""
+
+    def __init__(self, recorded, latency):
+        self.recorded = recorded
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self._transcribe))
+
+    def _chat(self, model=None, messages=(), **kwargs):
+        time.sleep(self.latency)
+        user_messages = [m['content'] for m in messages if m.get('role') == 'user' and isinstance(m.get('content'), str)]
+        if user_messages and user_messages[-1] in self.recorded:
+            return _completion(self.recorded[user_messages[-1]])
+        return _completion(f"Синтетический ответ модели {model}.")
+
+    def _transcribe(self, model=None, file=None, **kwargs):
+        time.sleep(self.latency)
+        return SimpleNamespace(text="Синтетическая транскрипция.")
+
+
+class FakeGemini:
+    """Подмена Gemini-клиента."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.models = SimpleNamespace(generate_content=self._generate)
+
+    def _generate(self, model=None, contents=None, **kwargs):
+        time.sleep(self.latency)
+        return SimpleNamespace(text=f"Синтетический анализ видео моделью {model}.")
+
+
+def patch_bot(assistant_bot, recorded, latency):
+    """Подменяет все внешние вызовы бота."""
+    from downloads import DownloadedFile
+
+    message_ids = itertools.count(1)
+
+    def sent_message(chat_id=None, text=None, **kwargs):
+        failures.check_reply(text)
+        return SimpleNamespace(message_id=next(message_ids), chat=SimpleNamespace(id=chat_id), text=text)
+
+    telegram = assistant_bot.bot
+    telegram.threaded = False
+    telegram.reply_to = lambda message, text, **kwargs: sent_message(message.chat.id, text)
+    telegram.send_message = lambda chat_id, text, **kwargs: sent_message(chat_id, text)
+    telegram.send_photo = lambda chat_id, photo=None, caption=None, **kwargs: sent_message(chat_id, caption)
+    telegram.edit_message_text = lambda text, chat_id=None, message_id=None, **kwargs: sent_message(chat_id, text)
+    telegram.get_file = lambda file_id: SimpleNamespace(file_path=f"replay/{file_id}.bin")
+
+    def fake_download(file_id, kind, suffix, checkpoint_dir=None):
+        time.sleep(latency)
+        content = minimal_pdf(f"Replay document {file_id}") if kind == 'document' else b'\0' * REPLAY_FILE_SIZE
+        return DownloadedFile(f"{file_id}{suffix or '.bin'}", buffer=io.BytesIO(content))
+
+    # Вместо OpenCV — один синтетический кадр (скачанное «видео» — нули)
+    frame = base64.b64encode(b'replay-frame').decode('utf-8')
+
+    assistant_bot.downloads._download = fake_download
+    assistant_bot.extract_video_frames = lambda video_path, max_frames=5: [frame]
+    assistant_bot.extract_text_from_url = lambda url: f"Синтетический текст страницы {url}"
+    assistant_bot.client = FakeOpenAI(recorded, latency)
+    assistant_bot.gemini_client = FakeGemini(latency)
+    if failures not in logging.getLogger().handlers:
+        logging.getLogger().addHandler(failures)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def print_report(results, wall_time):
+    by_type = defaultdict(list)
+    for message_type, latency, ok in results:
+        by_type[message_type].append((latency, ok))
+
+    print()
+    print(f"{'Тип':<10} {'Кол-во':>7} {'Ошибки':>7} {'Среднее':>9} {'p50':>8} {'p95':>8} {'Макс':>8} {'Сообщ/с':>9}")
+    for message_type in sorted(by_type):
+        latencies = [latency for latency, _ in by_type[message_type]]
+        errors = sum(1 for _, ok in by_type[message_type] if not ok)
+        print(f"{message_type:<10} {len(latencies):>7} {errors:>7} "
+              f"{sum(latencies) / len(latencies):>9.3f} {percentile(latencies, 0.5):>8.3f} "
+              f"{percentile(latencies, 0.95):>8.3f} {max(latencies):>8.3f} "
+              f"{len(latencies) / wall_time if wall_time else 0:>9.2f}")
+    total = len(results)
+    print(f"\nВсего: {total} сообщений за {wall_time:.1f} с ({total / wall_time if wall_time else 0:.2f} сообщ/с)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение нагрузки из журнала бота")
+    parser.add_argument('log', nargs='?', default=os.path.join('logs', 'telegram_bot_logs.csv'),
+                        help="CSV-журнал взаимодействий")
+    parser.add_argument('--speedup', type=float, default=1.0,
+                        help="Коэффициент сжатия времени (10 — в 10 раз быстрее реального трафика)")
+    parser.add_argument('--concurrency', type=int, default=8, help="Количество потоков-обработчиков")
+    parser.add_argument('--upstream-latency', type=float, default=0.2,
+                        help="Синтетическая задержка внешних вызовов в секундах")
+    parser.add_argument('--limit', type=int, default=None, help="Воспроизвести только первые N записей")
+    parser.add_argument('--verbose', action='store_true', help="Показывать журнал работы бота")
+    parser.add_argument('--max-gap', type=float, default=60.0,
+                        help="Максимальная пауза между сообщениями в секундах (после сжатия)")
+    args = parser.parse_args()
+
+    entries = load_trace(args.log, args.limit)
+    if not entries:
+        print("Журнал пуст — нечего воспроизводить.")
+        return
+
+    # Бот пишет журналы и индексы во временную папку и не ходит во внешние сервисы
+    os.environ['BOT_LOGS_DIR'] = tempfile.mkdtemp(prefix='replay_logs_')
+    os.environ['TELEGRAM_BOT_TOKEN'] = '0:replay'
+    os.environ['OPENAI_API_KEY'] = 'replay'
+    os.environ['GEMINI_API_KEY'] = ''
+    import bot as assistant_bot
+    from telebot import types
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    recorded = {entry.message: entry.ai_response for entry in entries if entry.ai_response}
+    patch_bot(assistant_bot, recorded, args.upstream_latency)
+    assistant_bot.initialize_log_file()
+
+    # Расписание: смещение от начала журнала с учетом сжатия и ограничения пауз
+    schedule = []
+    offset = 0.0
+    for index, entry in enumerate(entries):
+        if index:
+            gap = (entry.timestamp - entries[index - 1].timestamp).total_seconds() / args.speedup
+            offset += min(max(gap, 0.0), args.max_gap)
+        schedule.append((offset, entry, build_update(index + 1, entry)))
+
+    results = []
+    results_lock = threading.Lock()
+
+    def run(scheduled_at, entry, raw_update):
+        failures.take()
+        try:
+            assistant_bot.bot.process_new_updates([types.Update.de_json(raw_update)])
+        except Exception as e:
+            print(f"Ошибка при обработке записи ({entry.message_type}): {e}", file=sys.stderr)
+            failures.take()
+            ok = False
+        else:
+            # Обработчики перехватывают исключения и отвечают текстом ошибки
+            handler_failures = failures.take()
+            ok = not handler_failures
+            if handler_failures:
+                print(f"Ошибка при обработке записи ({entry.message_type}): {handler_failures[0]}", file=sys.stderr)
+        with results_lock:
+            results.append((entry.message_type, time.monotonic() - scheduled_at, ok))
+
+    print(f"Воспроизводим {len(schedule)} сообщений, сжатие x{args.speedup}, "
+          f"длительность ~{schedule[-1][0]:.1f} с")
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for offset, entry, raw_update in schedule:
+            delay = started + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(run, started + offset, entry, raw_update)
+    print_report(results, time.monotonic() - started)
+
+
+if __name__ == '__main__':
+    main()
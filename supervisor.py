@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+Многопроцессный режим запуска бота (супервизор).
+
+Один процесс-приемщик получает апдейты из Telegram (long polling) и раздает их
+N рабочим процессам через локальные очереди multiprocessing. Апдейт попадает
+в процесс по консистентному хешированию chat_id, поэтому история разговора и
+порядок сообщений одного чата остаются внутри одного процесса, а тяжелая
+обработка медиа (OpenCV, PyPDF2) распределяется по всем ядрам. Внутри процесса
+апдейты обрабатываются несколькими потоками-«полосами»; чат закреплен за
+одной полосой, поэтому его сообщения обрабатываются строго по очереди.
+
+Процесс-приемщик не импортирует bot.py: он только получает апдейты, отсеивает повторы,
+сохраняет их в очередь и раздает рабочим процессам.
+
+Упавшие процессы перезапускаются; пока процесс недоступен, его чаты
+временно переходят к соседним процессам кольца.
+
+Апдейты сохраняются в надежную очередь (logs/jobs.sqlite3) до того, как
+Telegram получит подтверждение. Апдейты, которые упавший процесс не успел
+завершить, и незавершенные апдейты предыдущего запуска возвращаются в
+обработку и продолжаются с последней контрольной точки.
+
+Запуск:
+    python supervisor.py --workers 4
+"""
+
+import argparse
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+import time
+
+try:
+    import telebot
+    from telebot import apihelper
+    from dotenv import load_dotenv
+except ImportError as e:
+    print(f"❌ Ошибка импорта: {e}")
+    print("💡 Установите зависимости: pip install -r requirements.txt")
+    sys.exit(1)
+
+from dedup import open_update_index
+from job_queue import QUEUED_UPDATE_KEYS, open_job_queue
+
+# Сколько раз процесс может упасть за окно RESTART_WINDOW, прежде чем
+# его слот будет временно выведен из кольца
+MAX_RESTARTS = 3
+RESTART_WINDOW = 60
+RESTART_COOLDOWN = 30
+
+
+class HashRing:
+    """
+    Консистентное хеширование ключей (chat_id) по слотам рабочих процессов.
+
+    Каждый слот представлен несколькими виртуальными узлами, поэтому при
+    удалении слота из кольца к соседям переходят только его собственные чаты.
+    """
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self._keys = []
+        self._ring = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value):
+        return int(hashlib.md5(str(value).encode('utf-8')).hexdigest(), 16)
+
+    def add(self, node):
+        for i in range(self.replicas):
+            key = self._hash(f"{node}:{i}")
+            if key not in self._ring:
+                self._ring[key] = node
+                bisect.insort(self._keys, key)
+
+    def remove(self, node):
+        for i in range(self.replicas):
+            key = self._hash(f"{node}:{i}")
+            if self._ring.get(key) == node:
+                del self._ring[key]
+                self._keys.remove(key)
+
+    def __contains__(self, node):
+        return node in self._ring.values()
+
+    def get(self, value):
+        """Возвращает слот для ключа или None, если кольцо пустое."""
+        if not self._keys:
+            return None
+        index = bisect.bisect(self._keys, self._hash(value)) % len(self._keys)
+        return self._ring[self._keys[index]]
+
+
+def extract_chat_id(raw_update):
+    """Возвращает chat_id из сырого апдейта (dict) или None."""
+    for key in QUEUED_UPDATE_KEYS:
+        message = raw_update.get(key)
+        if message and 'chat' in message:
+            return message['chat']['id']
+    return None
+
+
+def update_key(raw_update):
+    """Ключ маршрутизации апдейта: chat_id, а без чата — update_id."""
+    chat_id = extract_chat_id(raw_update)
+    return chat_id if chat_id is not None else raw_update.get('update_id')
+
+
+def worker_main(slot, update_queue, threads):
+    """
+    Рабочий процесс: импортирует бота (регистрирует обработчики) и
+    обрабатывает апдейты из своей очереди. Элемент очереди — кортеж
+    (сырой апдейт, resume); resume=True означает продолжение апдейта из
+    надежной очереди после сбоя. Проверку на повтор выполняет супервизор.
+
+    Апдейты раздаются по threads полосам по chat_id; каждая полоса
+    обрабатывает свои апдейты последовательно, поэтому сообщения одного
+    чата не обгоняют друг друга и не пишут в его историю одновременно.
+    """
+    # Номер слота нужен боту при импорте (например, для отдельного файла трассировки)
+    os.environ['BOT_WORKER_SLOT'] = str(slot)
+    import bot as assistant_bot
+
+    # Обработчики вызываются прямо в потоке полосы, без общего пула telebot
+    assistant_bot.bot.threaded = False
+
+    def run_lane(lane):
+        while True:
+            item = lane.get()
+            if item is None:
+                break
+            assistant_bot.load_shedder.dequeued()
+            raw_update, resume = item
+            try:
+                update = telebot.types.Update.de_json(raw_update)
+                if resume:
+                    assistant_bot.bot.resume_updates([update])
+                else:
+                    assistant_bot.bot.process_checked_updates([update])
+            except Exception as e:
+                logging.error(f"Рабочий процесс {slot}: ошибка обработки апдейта {raw_update.get('update_id')}: {e}")
+
+    logging.info(f"Рабочий процесс {slot} запущен (pid {os.getpid()}, полос: {threads})")
+    assistant_bot.initialize_log_file()
+    lanes = [queue.Queue() for _ in range(threads)]
+    lane_threads = [threading.Thread(target=run_lane, args=(lane,), name=f"lane-{i}", daemon=True)
+                    for i, lane in enumerate(lanes)]
+    for thread in lane_threads:
+        thread.start()
+    while True:
+        item = update_queue.get()
+        if item is None:
+            break
+        # Ожидающие в полосах апдейты учитываются в уровне нагрузки: иначе он видел бы
+        # только выполняющиеся обработчики (не больше threads) и не доходил до DEFER
+        assistant_bot.load_shedder.enqueued()
+        lanes[HashRing._hash(update_key(item[0])) % threads].put(item)
+    for lane in lanes:
+        lane.put(None)
+    for thread in lane_threads:
+        thread.join()
+    logging.info(f"Рабочий процесс {slot} остановлен")
+
+
+class Supervisor:
+    """Процесс-приемщик: polling Telegram, маршрутизация апдейтов и надзор за процессами."""
+
+    def __init__(self, token, workers, allowed_updates, jobs, update_index, poll_timeout=10, threads=4):
+        self.token = token
+        self.jobs = jobs
+        self.update_index = update_index
+        self.threads = threads
+        self.workers = workers
+        self.allowed_updates = allowed_updates
+        self.poll_timeout = poll_timeout
+        self.ctx = multiprocessing.get_context('spawn')
+        self.ring = HashRing()
+        self.processes = {}
+        self.queues = {}
+        self.crashes = {slot: [] for slot in range(workers)}
+        self.restart_at = {}
+        self.offset = None
+
+    def _start_worker(self, slot):
+        update_queue = self.ctx.Queue()
+        process = self.ctx.Process(target=worker_main, args=(slot, update_queue, self.threads),
+                                   name=f"bot-worker-{slot}", daemon=True)
+        process.start()
+        self.processes[slot] = process
+        self.queues[slot] = update_queue
+        self.ring.add(slot)
+
+    def _drain(self, update_queue):
+        """Забирает апдейты, которые упавший процесс не успел обработать."""
+        pending = []
+        while True:
+            try:
+                pending.append(update_queue.get_nowait())
+            except (queue.Empty, OSError, ValueError):
+                break
+        return [item for item in pending if item is not None]
+
+    def dispatch(self, raw_update, resume=False):
+        slot = self.ring.get(update_key(raw_update))
+        if slot is None:
+            # Апдейт остается в надежной очереди и будет продолжен при следующем запуске
+            logging.error(f"Нет доступных рабочих процессов, апдейт {raw_update.get('update_id')} отложен")
+            return
+        self.queues[slot].put((raw_update, resume))
+
+    def _lost_jobs(self, slot, drained):
+        """
+        Апдейты из надежной очереди, которые упавший процесс взял в работу,
+        но не завершил (не считая оставшихся в его локальной очереди).
+        """
+        drained_ids = {raw_update['update_id'] for raw_update, _ in drained}
+        lost = set()
+        for update_id, chat_id in self.jobs.pending_ids():
+            key = chat_id if chat_id is not None else update_id
+            if update_id not in drained_ids and self.ring.get(key) == slot:
+                lost.add(update_id)
+        return self.jobs.take_resumable(lost) if lost else []
+
+    def check_workers(self):
+        """Перезапускает упавшие процессы и перераспределяет их апдейты."""
+        now = time.monotonic()
+        for slot in range(self.workers):
+            process = self.processes.get(slot)
+            if process is not None and process.is_alive():
+                continue
+
+            if process is not None:
+                logging.error(f"Рабочий процесс {slot} завершился (код {process.exitcode})")
+                pending = self._drain(self.queues.pop(slot))
+                # Определяем брошенные апдейты, пока слот еще в кольце
+                lost = self._lost_jobs(slot, pending)
+                self.ring.remove(slot)
+                del self.processes[slot]
+                self.crashes[slot] = [t for t in self.crashes[slot] if now - t < RESTART_WINDOW] + [now]
+                if len(self.crashes[slot]) >= MAX_RESTARTS:
+                    logging.error(f"Процесс {slot} часто падает, слот выведен из кольца на {RESTART_COOLDOWN} с")
+                    self.restart_at[slot] = now + RESTART_COOLDOWN
+                else:
+                    self._start_worker(slot)
+                for raw_update, resume in pending:
+                    self.dispatch(raw_update, resume)
+                if lost:
+                    logging.warning(f"Продолжаем незавершенные апдейты процесса {slot}: {len(lost)}")
+                for raw_update in lost:
+                    self.dispatch(raw_update, resume=True)
+                continue
+
+            if now >= self.restart_at.get(slot, 0):
+                self.restart_at.pop(slot, None)
+                self.crashes[slot] = []
+                logging.info(f"Запускаем рабочий процесс {slot}")
+                self._start_worker(slot)
+
+    def run(self):
+        for slot in range(self.workers):
+            self._start_worker(slot)
+        logging.info(f"Супервизор запущен: {self.workers} рабочих процессов")
+
+        try:
+            apihelper.delete_webhook(self.token)
+        except Exception:
+            pass
+        # Продолжаем апдейты, не завершенные до перезапуска; накопившиеся в
+        # Telegram апдейты не пропускаем — обработанные отсеет индекс повторов
+        for raw_update in self.jobs.take_resumable():
+            self.dispatch(raw_update, resume=True)
+
+        try:
+            while True:
+                self.check_workers()
+                try:
+                    updates = apihelper.get_updates(
+                        self.token, offset=self.offset, timeout=self.poll_timeout,
+                        allowed_updates=self.allowed_updates, long_polling_timeout=self.poll_timeout)
+                except Exception as e:
+                    logging.error(f"Ошибка при получении апдейтов: {e}")
+                    time.sleep(3)
+                    continue
+                for raw_update in updates:
+                    self.offset = raw_update['update_id'] + 1
+                    # Повтор отсеиваем до записи в очередь: иначе его запись осталась бы
+                    # незавершенной и была бы обработана заново после перезапуска
+                    if not self.update_index.check_and_mark(telebot.types.Update.de_json(raw_update)):
+                        logging.info(f"Пропускаем повторный апдейт {raw_update['update_id']}")
+                        continue
+                    # Апдейт записывается на диск до подтверждения (следующего getUpdates)
+                    try:
+                        self.jobs.enqueue(raw_update)
+                    except Exception as e:
+                        logging.error(f"Не удалось сохранить апдейт {raw_update.get('update_id')} в очередь: {e}")
+                    self.dispatch(raw_update)
+        except KeyboardInterrupt:
+            logging.info("Супервизор остановлен пользователем")
+        finally:
+            self.stop()
+
+    def stop(self):
+        for update_queue in self.queues.values():
+            try:
+                update_queue.put(None)
+            except Exception:
+                pass
+        for process in self.processes.values():
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Многопроцессный запуск Telegram бота")
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('BOT_WORKERS', os.cpu_count() or 1)),
+                        help="Количество рабочих процессов (по умолчанию BOT_WORKERS или число ядер)")
+    parser.add_argument('--threads', type=int, default=int(os.getenv('BOT_WORKER_THREADS', 4)),
+                        help="Количество потоков обработки в каждом процессе (по умолчанию BOT_WORKER_THREADS или 4)")
+    parser.add_argument('--poll-timeout', type=int, default=10,
+                        help="Таймаут long polling в секундах")
+    args = parser.parse_args()
+
+    load_dotenv('config.env')
+    logging.basicConfig(level=logging.INFO)
+
+    token = os.getenv('TELEGRAM_BOT_TOKEN')
+    if not token:
+        logging.critical("Необходимо установить переменную окружения TELEGRAM_BOT_TOKEN в файле config.env!")
+        sys.exit(1)
+
+    logs_dir = os.getenv('BOT_LOGS_DIR', 'logs')
+    os.makedirs(logs_dir, exist_ok=True)
+
+    Supervisor(token, max(1, args.workers), list(QUEUED_UPDATE_KEYS), open_job_queue(logs_dir),
+               open_update_index(logs_dir),
+               poll_timeout=args.poll_timeout, threads=max(1, args.threads)).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Трассировка обработки апдейтов: trace ID на каждый апдейт и вложенные спаны
+(обработчик → загрузка → извлечение → вызов модели → ответ → запись лога).
+
+Спаны пишутся построчно в JSON (JSONL) с ротацией файла. Поля совпадают с
+моделью данных OpenTelemetry (traceId, spanId, parentSpanId, startTimeUnixNano,
+endTimeUnixNano, attributes, status), поэтому файл можно переслать в OTLP
+коллектор без преобразования структуры.
+
+Дополнительно можно включить выборочное профилирование: cProfile снимается
+для каждого апдейта, но сохраняется только для самых медленных N% из них.
+"""
+
+import contextvars
+import cProfile
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import secrets
+import threading
+import time
+from collections import deque
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """Один участок работы внутри трассы."""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'status', 'tracer')
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes)
+        self.status = 'OK'
+
+    @property
+    def duration(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'startTimeUnixNano': self.start_ns,
+            'endTimeUnixNano': self.end_ns,
+            'attributes': self.attributes,
+            'status': {'code': self.status},
+        }
+
+
+class _SpanContext:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span = None
+        self.token = None
+        self.profiler = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span = Span(self.tracer, self.name, trace_id, parent.span_id if parent else None, self.attributes)
+        self.token = _current_span.set(self.span)
+        if parent is None:
+            self.profiler = self.tracer._start_profile()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self.span
+        if exc is not None:
+            span.status = 'ERROR'
+            span.attributes['exception'] = repr(exc)
+        span.end_ns = time.time_ns()
+        _current_span.reset(self.token)
+        if span.parent_id is None:
+            self.tracer._finish_profile(self.profiler, span)
+        self.tracer.export(span)
+        return False
+
+
+class Tracer:
+    """
+    Args:
+        path (str): JSONL-файл для спанов (пустая строка — трассировка выключена).
+        max_bytes (int): Размер файла, после которого он ротируется.
+        backup_count (int): Сколько старых файлов хранить.
+        profile_percent (float): Доля самых медленных апдейтов (в %), для которых
+            сохраняется профиль cProfile. 0 — профилирование выключено.
+        profile_dir (str): Папка для файлов профиля (.prof).
+    """
+
+    WINDOW = 200
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5, profile_percent=0.0, profile_dir=None):
+        self.enabled = bool(path)
+        self.profile_percent = profile_percent
+        self.profile_dir = profile_dir
+        self._durations = deque(maxlen=self.WINDOW)
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('bot.tracing')
+        self._logger.propagate = False
+        if self.enabled:
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self._logger.addHandler(handler)
+            self._logger.setLevel(logging.INFO)
+        if profile_percent and profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def span(self, name, **attributes):
+        """Контекстный менеджер спана; без активной трассы начинает новую."""
+        return _SpanContext(self, name, attributes)
+
+    def traced(self, name):
+        """
+        Декоратор: оборачивает вызов функции в спан. Если первый аргумент —
+        сообщение Telegram, в атрибуты спана попадают chat_id и тип контента.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                attributes = {'function': func.__name__}
+                chat = getattr(args[0], 'chat', None) if args else None
+                if chat is not None:
+                    attributes['chat_id'] = chat.id
+                    attributes['message_id'] = getattr(args[0], 'message_id', None)
+                    attributes['content_type'] = getattr(args[0], 'content_type', None)
+                with self.span(name, **attributes):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def export(self, span):
+        if self.enabled:
+            try:
+                self._logger.info(json.dumps(span.to_dict(), ensure_ascii=False, default=str))
+            except Exception as e:
+                logging.warning(f"Не удалось записать спан {span.name}: {e}")
+
+    @staticmethod
+    def current_trace_id():
+        span = _current_span.get()
+        return span.trace_id if span else None
+
+    def _start_profile(self):
+        if not self.profile_percent or not self.profile_dir:
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Другой профилировщик уже активен в этом потоке
+            return None
+        return profiler
+
+    def _finish_profile(self, profiler, span):
+        if profiler is None:
+            return
+        profiler.disable()
+        with self._lock:
+            self._durations.append(span.duration)
+            ordered = sorted(self._durations)
+            threshold = ordered[int(len(ordered) * (1 - self.profile_percent / 100.0)) if len(ordered) > 1 else 0]
+        if span.duration >= threshold:
+            profile_path = os.path.join(self.profile_dir, f"{span.trace_id}.prof")
+            profiler.dump_stats(profile_path)
+            span.attributes['profile'] = profile_path
+            logging.info(f"Сохранен профиль медленного апдейта ({span.duration:.1f} с): {profile_path}")